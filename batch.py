@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+#
+# batch.py - Batch conversion of cached tracks
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, time, re, json, glob
+import hashlib
+import multiprocessing
+from optparse import OptionParser
+
+# Path
+d = os.path.dirname(sys.argv[0]) or '.'
+sys.path.insert(0, d + '/python-fitparse')
+
+# Local
+import trackfile, export
+import fit, gpx2, tcx
+
+# ###########################################################################
+# Conversion
+# ###########################################################################
+
+ENCODERS = {
+  'fit' : (fit.FitSink,  fit.VERSION),
+  'gpx' : (gpx2.GpxSink, gpx2.VERSION),
+  'tcx' : (tcx.TcxSink,  tcx.VERSION),
+}
+
+MANIFEST = '.batch-manifest.json'
+
+#
+# Hash file content
+#
+def file_hash ( path ):
+  h  = hashlib.sha1()
+  fp = open(path, 'rb')
+  try:
+    while True:
+      data = fp.read(65536)
+      if not data: break
+      h.update(data)
+  finally:
+    fp.close()
+  return h.hexdigest()
+
+#
+# Output path for a given track/format
+#
+def out_path ( tpath, fmt, odir ):
+  n = os.path.splitext(os.path.basename(tpath))[0] + '.' + fmt
+  return os.path.join(odir or os.path.dirname(tpath), n)
+
+#
+# Manifests of output hashes, one per output directory (loaded on demand)
+#
+# Entries are keyed by output file name and hold the track hash and the
+# encoder version, so a new encoder version makes outputs out of date
+#
+class Manifests:
+
+  def __init__ ( self ):
+    self._data = {}
+
+  def get ( self, opath ):
+    d = os.path.abspath(os.path.dirname(opath))
+    if d not in self._data:
+      try:
+        self._data[d] = json.load(open(os.path.join(d, MANIFEST)))
+      except (IOError, ValueError):
+        self._data[d] = {}
+    return self._data[d]
+
+  def save ( self ):
+    for d, m in self._data.items():
+      p   = os.path.join(d, MANIFEST)
+      tmp = p + '.tmp'
+      open(tmp, 'w').write(json.dumps(m))
+      os.rename(tmp, p)
+
+#
+# Manifest entry for a track hash and format
+#
+def entry ( thash, fmt ):
+  return '%s-v%d' % (thash, ENCODERS[fmt][1])
+
+#
+# Check whether output is up to date
+#
+def up_to_date ( tpath, opath, manifest, ehash ):
+  if not os.path.exists(opath):
+    return False
+  if manifest is not None:
+    return manifest.get(os.path.basename(opath)) == ehash
+  return os.path.getmtime(opath) >= os.path.getmtime(tpath)
+
+#
+# Convert a single track (run in worker process)
+#
+# All requested formats are generated in a single pass over the track
+#
+# Returns (track path, [(output path, bytes)], points, bytes in, error)
+#
+def convert ( job ):
+  tpath, outputs = job
+  try:
+    t    = trackfile.load(tpath)
+    ret  = []
+    outs = export.run(t['track'], t['static'],
+                      [ ENCODERS[fmt][0]() for fmt, opath in outputs ])
+    for (fmt, opath), data in zip(outputs, outs):
+      tmp  = opath + '.tmp'
+      open(tmp, 'wb').write(data)
+      os.rename(tmp, opath)
+      ret.append((opath, len(data)))
+    return (tpath, ret, len(t['track']), os.path.getsize(tpath), None)
+  except Exception, e:
+    return (tpath, [], 0, 0, str(e))
+
+#
+# Find track files from list of directories/globs
+#
+def find_tracks ( args ):
+  ret = []
+  for a in args:
+    a = os.path.expanduser(a)
+    if os.path.isdir(a):
+      a = os.path.join(a, '*.track')
+    ret.extend(p for p in glob.glob(a) if p.endswith('.track'))
+  return sorted(set(ret))
+
+# ###########################################################################
+# Main
+# ###########################################################################
+
+if __name__ == '__main__':
+
+  # Command line
+  optp = OptionParser(usage='%prog [options] dir|glob ...')
+  optp.add_option('-f', '--format', default=[], action='append',
+                  help='Output format (fit, gpx, tcx), may be repeated')
+  optp.add_option('-o', '--output', default=None,
+                  help='Output directory (default alongside input)')
+  optp.add_option('-j', '--jobs', default=multiprocessing.cpu_count(),
+                  type='int', help='Number of worker processes')
+  optp.add_option('--hash', default=False, action='store_true',
+                  help='Detect up to date outputs by content hash')
+  optp.add_option('--force', default=False, action='store_true',
+                  help='Convert even if outputs are up to date')
+  (opts, args) = optp.parse_args()
+  fmts = opts.format or [ 'fit' ]
+  for f in fmts:
+    if f not in ENCODERS:
+      optp.error('unknown format %s' % f)
+  odir = opts.output and os.path.expanduser(opts.output)
+  if odir and not os.path.exists(odir):
+    os.makedirs(odir)
+
+  # Manifests (kept alongside the outputs)
+  manifests = Manifests() if opts.hash else None
+
+  # Build job list
+  jobs   = []
+  hashes = {}
+  paths  = find_tracks(args)
+  for tpath in paths:
+    thash   = file_hash(tpath) if opts.hash else None
+    outputs = []
+    for f in fmts:
+      opath    = out_path(tpath, f, odir)
+      ehash    = entry(thash, f) if thash else None
+      manifest = manifests.get(opath) if manifests is not None else None
+      if opts.force or not up_to_date(tpath, opath, manifest, ehash):
+        outputs.append((f, opath))
+        hashes[opath] = ehash
+    if outputs:
+      jobs.append((tpath, outputs))
+  print '%d tracks, %d to convert' % (len(paths), len(jobs))
+
+  # Convert
+  t0   = time.time()
+  pool = multiprocessing.Pool(max(1, opts.jobs))
+  ntrk = npts = nin = nout = nerr = 0
+  for tpath, ret, pts, sz, err in pool.imap_unordered(convert, jobs):
+    if err:
+      print '%s: error %s' % (tpath, err)
+      nerr += 1
+      continue
+    ntrk += 1
+    npts += pts
+    nin  += sz
+    for opath, n in ret:
+      nout += n
+      if manifests is not None:
+        manifests.get(opath)[os.path.basename(opath)] = hashes[opath]
+  pool.close()
+  pool.join()
+  dt = max(time.time() - t0, 1e-6)
+
+  # Save manifests
+  if manifests is not None:
+    manifests.save()
+
+  # Report
+  print 'converted %d tracks (%d errors) in %.2fs' % (ntrk, nerr, dt)
+  print '  %.1f tracks/s, %.0f points/s, %.2f MB/s in, %.2f MB/s out' %\
+        (ntrk / dt, npts / dt, nin / dt / 1048576, nout / dt / 1048576)
+  sys.exit(1 if nerr else 0)
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+#
+# bench.py - Conversion pipeline benchmarks
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, time, json, math, random
+import resource
+from optparse import OptionParser
+
+# Path
+d = os.path.dirname(sys.argv[0]) or '.'
+sys.path.insert(0, d + '/python-fitparse')
+
+# Local
+import track
+from fit  import fit_activity
+from gpx2 import gpx_activity
+
+# ###########################################################################
+# Synthetic tracks
+# ###########################################################################
+
+#
+# Bryton-like track/log points (see brytongps)
+#
+class TrackPoint:
+  def __init__ ( self, timestamp, latitude, longitude, elevation ):
+    self.timestamp = timestamp
+    self.latitude  = latitude
+    self.longitude = longitude
+    self.elevation = elevation
+
+class LogPoint:
+  def __init__ ( self, timestamp, speed, cadence, heartrate, temperature ):
+    self.timestamp   = timestamp
+    self.speed       = speed
+    self.cadence     = cadence
+    self.heartrate   = heartrate
+    self.temperature = temperature
+
+#
+# Generate merged segments for a ride of given duration (hours)
+#
+# Rides are split into segments by pauses (gaps), have occasional GPS
+# dropouts (log points without a track point) and, if static, a fixed
+# position (trainer ride)
+#
+def synth_segments ( hours, static = False, seed = 1, interval = 1 ):
+  rnd   = random.Random(seed)
+  t     = 1400000000
+  lat   = 51.5
+  lon   = -1.5
+  ele   = 100.0
+  hdg   = rnd.uniform(0, 2 * math.pi)
+  speed = 25.0
+  end   = t + int(hours * 3600)
+  segs  = []
+  seg   = []
+  drop  = 0
+
+  while t < end:
+
+    # Pause (new segment)
+    if seg and rnd.random() < 0.0005:
+      segs.append(seg)
+      seg  = []
+      t   += rnd.randint(30, 600)
+      continue
+
+    # Ride dynamics
+    speed = min(60.0, max(0.0, speed + 0.05 * (25.0 - speed) +\
+                               rnd.gauss(0, 1.0)))
+    hdg  += rnd.gauss(0, 0.05)
+    ele   = ele + 0.01 * (100.0 - ele) + rnd.gauss(0, 0.3)
+    if not static:
+      d    = (speed / 3600.0) * interval / 111.0
+      lat += d * math.cos(hdg)
+      lon += d * math.sin(hdg) / math.cos(math.radians(lat))
+
+    # GPS dropout
+    if drop == 0 and not static and rnd.random() < 0.002:
+      drop = rnd.randint(5, 120)
+
+    lp = LogPoint(t, speed, int(rnd.gauss(85, 5)), int(rnd.gauss(140, 10)),
+                  20.0 + rnd.random())
+    tp = None
+    if drop:
+      drop -= 1
+    else:
+      tp = TrackPoint(t, lat, lon, ele)
+    seg.append((tp, lp))
+    t += interval
+
+  if seg: segs.append(seg)
+  return segs
+
+#
+# Device history of synthetic rides (see brytongps), each ride's segments
+# are generated when first read and then kept by the ride, as on the device
+#
+class SynthRide:
+  def __init__ ( self, hours, seed ):
+    self._hours = hours
+    self._seed  = seed
+    self._segs  = None
+
+  def merged_segments ( self, remove_empty = False ):
+    if self._segs is None:
+      self._segs = synth_segments(self._hours, seed=self._seed)
+    return self._segs
+
+class SynthDevice:
+  def __init__ ( self, rides, hours ):
+    self._rides = rides
+    self._hours = hours
+
+  def read_history ( self, dev ):
+    return [ SynthRide(self._hours, i + 1) for i in range(self._rides) ]
+
+# ###########################################################################
+# Measurement
+# ###########################################################################
+
+#
+# Peak memory (kB) used by fn(*args), measured in a forked child so that
+# each stage gets its own high water mark
+#
+def peak_memory ( fn, *args ):
+  r, w = os.pipe()
+  pid  = os.fork()
+  if pid == 0:
+    os.close(r)
+    m0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    fn(*args)
+    m1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    os.write(w, str(m1 - m0))
+    os._exit(0)
+  os.close(w)
+  ret = os.read(r, 64)
+  os.close(r)
+  os.waitpid(pid, 0)
+  return int(ret or 0)
+
+#
+# Run and time a stage
+#
+def measure ( name, points, memory, fn, *args ):
+  mem = peak_memory(fn, *args) if memory else None
+  t0  = time.time()
+  ret = fn(*args)
+  dt  = max(time.time() - t0, 1e-9)
+  return ret, {
+    'stage'    : name,
+    'points'   : points,
+    'seconds'  : dt,
+    'rate'     : points / dt,
+    'peak_kb'  : mem,
+  }
+
+#
+# Benchmark full pipeline for one synthetic ride
+#
+def bench ( hours, conf, static = False, memory = True ):
+  res  = []
+  segs = synth_segments(hours, static)
+  n    = sum(len(s) for s in segs)
+
+  # Convert
+  t, r = measure('convert', n, memory, track.convert, segs)
+  res.append(r)
+
+  # Fixups (in pipeline order)
+  stages = [ track.fixup_static ]
+  if not static:
+    stages += [ track.fixup_crop, track.fixup_missing,
+                track.fixup_extrapolate, track.fixup_speed ]
+  for fn in stages:
+    t, r = measure(fn.__name__, len(t['track']), memory, fn, t, conf)
+    res.append(r)
+
+  # Encoders
+  for fn in [ fit_activity, gpx_activity ]:
+    _, r = measure(fn.__name__, len(t['track']), memory,
+                   fn, t['track'], t['static'])
+    res.append(r)
+
+  return res
+
+#
+# Read and convert every ride of a device (as a device dump)
+#
+def dump ( rides, hours ):
+  import device
+  dev = device.Device(SynthDevice(rides, hours), None)
+  for h in dev.history():
+    t = track.convert(dev.segments(h))
+
+#
+# Benchmark device dumps of one and of several rides (peak memory should
+# not grow with the number of rides)
+#
+def bench_dump ( hours, rides, memory = True ):
+  res = []
+  n   = [ sum(len(s) for s in synth_segments(hours, seed=i + 1))
+          for i in range(rides) ]
+  for r in sorted(set([ 1, rides ])):
+    _, m = measure('dump-%d' % r, sum(n[:r]), memory, dump, r, hours)
+    res.append(m)
+  return res
+
+# ###########################################################################
+# Main
+# ###########################################################################
+
+if __name__ == '__main__':
+
+  # Command line
+  optp = OptionParser(usage='%prog [options]')
+  optp.add_option('-s', '--size', default=[], action='append', type='float',
+                  help='Ride duration in hours (default 1, 10, 100)')
+  optp.add_option('--static', default=False, action='store_true',
+                  help='Benchmark static (trainer) rides')
+  optp.add_option('--no-memory', default=False, action='store_true',
+                  help='Do not measure peak memory')
+  optp.add_option('-d', '--dump', default=0, type='int', metavar='RIDES',
+                  help='Also benchmark a device dump of RIDES rides')
+  optp.add_option('-b', '--baseline', default=None,
+                  help='Baseline file to compare against')
+  optp.add_option('--save', default=None,
+                  help='Save results as a baseline file')
+  optp.add_option('-t', '--tolerance', default=0.2, type='float',
+                  help='Allowed slowdown vs baseline (fraction)')
+  (opts, args) = optp.parse_args()
+
+  # Pipeline configuration (as bryton-sync defaults)
+  conf = {
+    'min_speed'     : 15.0,
+    'move_distance' : 5.0,
+    'update_period' : 1.0,
+  }
+
+  # Load baseline
+  base = {}
+  if opts.baseline:
+    base = json.load(open(opts.baseline))
+
+  # Run
+  results = {}
+  regress = 0
+  print '%-10s %-18s %9s %9s %11s %9s  %s' %\
+        ('size', 'stage', 'points', 'secs', 'points/s', 'peak MB', 'baseline')
+  for h in opts.size or [ 1, 10, 100 ]:
+    key = '%gh%s' % (h, '-static' if opts.static else '')
+    results[key] = res = bench(h, conf, opts.static, not opts.no_memory)
+    if opts.dump:
+      res += bench_dump(h, opts.dump, not opts.no_memory)
+    prev = dict((r['stage'], r) for r in base.get(key, []))
+    for r in res:
+      cmp = ''
+      if r['stage'] in prev:
+        ratio = r['rate'] / prev[r['stage']]['rate']
+        cmp   = '%+.0f%%' % ((ratio - 1) * 100)
+        if ratio < 1 - opts.tolerance:
+          cmp     += ' REGRESSION'
+          regress += 1
+      mem = '%.1f' % (r['peak_kb'] / 1024.0) if r['peak_kb'] is not None\
+            else '-'
+      print '%-10s %-18s %9d %9.3f %11.0f %9s  %s' %\
+            (key, r['stage'], r['points'], r['seconds'], r['rate'], mem, cmp)
+
+  # Save baseline
+  if opts.save:
+    open(opts.save, 'w').write(json.dumps(results, indent=2, sort_keys=True))
+
+  sys.exit(1 if regress else 0)
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
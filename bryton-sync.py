@@ -23,12 +23,10 @@
 
 # System
 import os, sys, time, re, json
-import threading, inotifyx, select, datetime, shutil
+START = time.time()
+import threading, inotifyx, select, datetime, shutil, resource, heapq
+from cStringIO     import StringIO
 from optparse      import OptionParser
-import gi
-gi.require_version('Gtk', '3.0')
-gi.require_version('Notify', '0.7')
-from gi.repository import Gtk, Gdk, Notify
 
 # Path
 d = os.path.dirname(sys.argv[0]) or '.'
@@ -39,11 +37,16 @@ sys.path.insert(0, d + '/python-fitparse')
 # Local
 from brytongps  import export_fake_garmin, rider40
 from device     import DeviceMonitor
-from log        import log
+from log        import log, log_configure, WARNING, ERROR
 from stravasync import Strava
-from fit        import fit_activity
-from gpx2       import gpx_activity
-import track
+from notify     import notifier
+from watermark  import Watermarks
+from poller     import UploadPoller, READY, DUPLICATE
+from dedup      import DedupIndex, content_hash, fingerprint
+from exportcache import ExportCache, ENCODERS
+from timeindex  import TimeIndex
+from spatialindex import SpatialIndex
+import track, trackfile, compress, metrics, profiling, replay, summary
 
 # ###########################################################################
 # Helpers
@@ -182,17 +185,56 @@ class BrytonSync ( threading.Thread ):
     self._conf = conf
     self._id   = None
     self._wd   = None
+
+    # Archive copies still being written and uploads still processing
+    self._lock      = threading.Lock()
+    self._archiving = set()
+    self._uploading = set()
+
+    # Pending retries (heap of (due, path), at most one per path) and
+    # attempt counts
+    self._timers    = []
+    self._scheduled = set()
+    self._retries   = {}
+    self._wake      = os.pipe()
     
     # Initialise device monitor
     self._devmon = DeviceMonitor(conf, self.device_add, self.device_rem)
 
     # Strava connection
     self._strava  = Strava(conf)
+    self._poller  = UploadPoller(self._strava, self.uploaded, conf)
+
+    # Per device sync progress
+    self._watermarks = Watermarks(conf['watermark_file'])
+
+    # Content of tracks already synced
+    self._dedup      = DedupIndex(conf['dedup_file'])
+    self._keys       = {} # track path -> (mtime, (hash, fingerprint))
+
+    # Ride statistics
+    self._summaries  = summary.SummaryIndex(conf['summary_file'])
+
+    # Cached tracks by time
+    self._tindex     = TimeIndex(conf['track_index'])
+
+    # Cached tracks by location
+    self._sindex     = SpatialIndex(conf['spatial_index'], conf['spatial_cell'])
 
-    # Libnotify
-    Notify.init('bryton-sync')
+    # Encoded activities
+    self._exports    = ExportCache(conf['export_cache_dir'],
+                                   conf['export_cache_size'])
+
+    # Notifications
+    self._notify  = notifier(conf)
 
     # StatusIcon
+    if not conf['headless']:
+      self.init_status_icon()
+
+  # Create status icon (imports GTK)
+  def init_status_icon ( self ):
+    from gi.repository import Gtk
     self._statusicon = Gtk.StatusIcon()
     self._statusicon.set_from_file('images/brytonsport.png')
     self._statusicon.set_title('BrytonSync')
@@ -207,6 +249,7 @@ class BrytonSync ( threading.Thread ):
     self._statusmenu.append(quit)
 
   def quit ( self, x ):
+    from gi.repository import Gtk
     self.stop()
     Gtk.main_quit()
   
@@ -216,10 +259,7 @@ class BrytonSync ( threading.Thread ):
 
   # Notify
   def notify ( self, title, msg, timeout = 2.0 ):
-    n = Notify.Notification.new(title, msg)
-    #n.set_data(title, msg)
-    n.set_timeout(timeout * 1000)
-    n.show()
+    self._notify.notify(title, msg, timeout)
   
   # Device connected
   def device_add ( self, dev ):
@@ -231,10 +271,32 @@ class BrytonSync ( threading.Thread ):
     log('device[%s] added (serial=%s)' % (prod, ser))
     self.notify('Device Added', 'Device: %s\nSerial: %s' % (prod, ser))
 
-    # Read tracks
-    history = list(reversed(dev.get_history()))
+    # Sync watermark (start of newest ride already cached), newest is the
+    # start of the newest ride read with no failed ride older than it
+    wm = None
+    if ser != 'Unknown' and not self._conf['resync']:
+      wm = self._watermarks.get(ser)
+    newest = None
+    done   = True
+
+    # Read tracks (newest first, until already synced history is reached)
+    with metrics.timer('device_read'):
+      history = dev.history()
     for h in history:
 
+      # Device removed
+      if dev.cancelled():
+        log('device[%s]: removed, stopping' % prod)
+        done = False
+        break
+
+      # Already synced
+      if wm is not None and h.summary.start <= wm:
+        log('device[%s]: reached synced history' % prod)
+        break
+      if newest is None:
+        newest = h.summary.start
+
       # Ignore short tracks
       if h.summary.distance  < self._conf['min_distance']: continue
       if h.summary.ride_time < self._conf['min_time']:     continue
@@ -244,7 +306,7 @@ class BrytonSync ( threading.Thread ):
       ts = time.strftime('%Y%m%d%H%M%S', tm)
       n = ts + '.track'
       p = os.path.join(tdir, n)
-      if os.path.exists(p): continue
+      if n in self._tindex or os.path.exists(p): continue
 
       # Log
       ts = time.strftime('%F %T', tm)
@@ -252,16 +314,47 @@ class BrytonSync ( threading.Thread ):
       self.notify('Track', 'Start: %s' % ts)
     
       # Create directory
-      if not os.path.exists(tdir):
+      try:
         os.makedirs(tdir)
+      except OSError:
+        pass
 
       # Get track data (from device)
-      t = track.convert(h.merged_segments(True))
-      t = track.fixup(t, self._conf)
-      
-      # Save in JSON format
-      open(p, 'w').write(json.dumps(t))
+      profiling.begin('device-' + os.path.splitext(n)[0])
+      try:
+        self.cache_track(dev, h, n, p)
+      except Exception, e:
+        log('device[%s]: failed to cache track %s' % (prod, ts), ERROR, e=e)
+        newest = None
+        continue
+      finally:
+        profiling.end()
       log('device[%s]: track cached' % (prod))
+
+    # Advance watermark (only if the whole new history was read)
+    if done and newest is not None and ser != 'Unknown':
+      self._watermarks.set(ser, newest)
+
+    metrics.export(self._conf)
+
+  # Read track from device and add to the cache
+  def cache_track ( self, dev, h, n, p ):
+    with metrics.timer('convert'), profiling.stage('convert'):
+      t = track.convert(dev.segments(h))
+    metrics.count('points', len(t['track']), stage='convert')
+    stats = summary.Summary()
+    with metrics.timer('fixup'), profiling.stage('fixup'):
+      t = track.fixup(t, self._conf, stats)
+    metrics.count('points', len(t['track']), stage='fixup')
+
+    # Save in binary cache format
+    with profiling.stage('save'):
+      trackfile.save(p, t, self._conf['compress'])
+    self._summaries.add(n, stats.result())
+    self._tindex.add(n, t['track'][0]['timestamp'],
+                     t['track'][-1]['timestamp'])
+    self._sindex.add(n, t)
+    metrics.count('tracks', stage='cached')
       
   # Device removed
   def device_rem ( self, dev ):
@@ -280,14 +373,29 @@ class BrytonSync ( threading.Thread ):
     if not os.path.exists(tdir):
       os.makedirs(tdir)
 
+    # Index existing cache (first run)
+    if not self._tindex.exists():
+      self._tindex.rebuild(tdir)
+
     # Setup inotify
     self._run = True
     self._id  = inotifyx.init()
-    self._wd  = inotifyx.add_watch(self._id, tdir)
+    self._wd  = inotifyx.add_watch(self._id, tdir,
+                                   inotifyx.IN_CLOSE_WRITE |\
+                                   inotifyx.IN_MOVED_TO)
+
+    # Bring spatial index up to date (in the background, as this loads each
+    # track not yet indexed, stopped early if we are)
+    t = threading.Thread(target=self._sindex.reconcile,
+                         args=(tdir, lambda: self._run), name='SpatialIndex')
+    t.daemon = True
+    t.start()
 
     # Start device monitor
     self._devmon.start()
-    if not self._conf['nosync']: threading.Thread.start(self)
+    if not self._conf['nosync']:
+      self._poller.start()
+      threading.Thread.start(self)
 
   # Stop
   def stop ( self ):
@@ -297,6 +405,9 @@ class BrytonSync ( threading.Thread ):
     self._id  = None
     self._wd  = None
     self._devmon.stop()
+    self._poller.stop()
+    self.wake()
+    metrics.export(self._conf)
   
   # File added
   def added ( self, tpath ):
@@ -311,34 +422,86 @@ class BrytonSync ( threading.Thread ):
       if not tpath.endswith('.track'):
         return True
 
-      # Ignore already synced
+      # Ignore already synced (or in progress)
       spath = os.path.join(sdir, os.path.basename(tpath))
-      if os.path.exists(spath):
+      if os.path.exists(spath) or self.pending(spath):
         return True
 
-      # Load the track
-      track = json.loads(open(tpath).read())
-      beg   = track['track'][0]['timestamp']
-      end   = track['track'][-1]['timestamp']
+      # Load the track header
+      with profiling.stage('header'):
+        hdr = trackfile.header(tpath)
+      beg   = hdr['timestamp']
+      end   = hdr['end']
       log('sync: new track found %s' %\
           time.strftime('%F %T', time.gmtime(beg)))
 
-      # See if this is already on strava (from somewhere else)
-      if not self._conf['nosend'] and on_strava(self._strava, beg, end):
-        log('sync: already found on strava')
+      # Overlaps a ride already synced (as on_strava, but local)
+      #
+      # Only the header has been read here, so the track is not added to
+      # the dedup index (that would mean loading it). The synced track it
+      # overlaps is already recorded there, and any later copy of this
+      # ride overlaps (or matches) that one in the same way.
+      #
+      name = os.path.basename(tpath)
+      if name not in self._tindex:
+        self._tindex.add(name, beg, end)
+      for b, e, n in self._tindex.overlapping(beg, end):
+        if n != name and os.path.exists(os.path.join(sdir, n)):
+          log('sync: overlaps synced track %s' % n)
+          metrics.count('tracks', stage='duplicate', match='overlap')
+          open(spath, 'w')
+          return True
+
+      # Track identity (remembered, so retries need not reload the track)
+      track = None
+      mtime = os.stat(tpath).st_mtime
+      with self._lock:
+        memo = self._keys.get(tpath)
+      if memo and memo[0] == mtime:
+        key = memo[1]
+      else:
+        with profiling.stage('load'):
+          track = trackfile.load(tpath)
+        with metrics.timer('dedup'), profiling.stage('dedup'):
+          key = (content_hash(track), fingerprint(track))
+        with self._lock:
+          self._keys[tpath] = (mtime, key)
+
+      # See if the same ride has already been synced (e.g. from another
+      # device or in another format)
+      found = self._dedup.lookup(*key)
+      if found:
+        log('sync: %s duplicate of %s' % found)
+        metrics.count('tracks', stage='duplicate', match=found[0])
+        self._dedup.add(os.path.basename(tpath), *key)
         open(spath, 'w')
         return True
 
-      # Create appropriate format
+      # See if this is already on strava (from somewhere else)
+      if not self._conf['nosend']:
+        with metrics.timer('on_strava'), profiling.stage('on_strava'):
+          found = on_strava(self._strava, beg, end)
+        if found:
+          log('sync: already found on strava')
+          metrics.count('tracks', stage='duplicate', match='strava')
+          self._dedup.add(os.path.basename(tpath), *key)
+          open(spath, 'w')
+          return True
+
+      # Create appropriate format, plus any backup formats (in memory, in a
+      # single pass over the track, or from the export cache)
       ext  = self._conf['format']
-      path = '/tmp/bryton.' + ext
-      if ext == 'fit':
-        t = fit_activity(track['track'], track['static'])
-      elif ext == 'gpx':
-        t = gpx_activity(track['track'], track['static'])
-      else:
+      if ext not in ENCODERS:
         return True
-      open(path, 'w').write(t)
+      fmts = [ ext ] + [ f for f in self._conf['backup_formats']
+                         if f != ext and f in ENCODERS ]
+      with metrics.timer('encode_' + ext), profiling.stage('encode_' + ext):
+        outs = self._exports.encode_all(key[0], fmts,
+                                        lambda: track or trackfile.load(tpath))
+      data = outs.pop(ext)
+      metrics.count('points', hdr['count'], stage='encode_' + ext)
+      for f, d in [ (ext, data) ] + outs.items():
+        metrics.count('bytes_encoded', len(d), format=f)
 
       # Send to strava
       log('syncing %s'%  os.path.basename(tpath))
@@ -346,64 +509,177 @@ class BrytonSync ( threading.Thread ):
       if self._conf['nosend']:
         log('  fake send')
         ok = True
-      elif self._strava.send_activity(path, ext):
-        self.notify('Track', 'Uploaded : %s' % tpath)
-        log('  sent')
-        ok = True
       else:
-        log('  failed')
-        # Will potentially try again next time
+        with metrics.timer('upload'), profiling.stage('upload'):
+          ok = self._strava.send_activity(data, ext)
+        if not ok:
+          log('  failed', WARNING)
+          return False
+        log('  sent')
+
+        # Wait for Strava to process the upload (in the background)
+        if ok is not True:
+          with self._lock:
+            self._uploading.add(spath)
+          self._poller.add(ok, (tpath, spath, data, key, outs))
+          return True
+        self.notify('Track', 'Uploaded : %s' % tpath)
+        metrics.count('tracks', stage='uploaded')
 
       if ok:
-        shutil.move(path, spath)
+        self._dedup.add(os.path.basename(tpath), *key)
+        self.archive(spath, data, outs)
 
       return True
 
     except Exception, e:
       import traceback
       traceback.print_exc(e)
-      log('error syncing [e=%s]' % e)
+      log('error syncing', ERROR, e=e)
 
     return False
 
-  # Scan
+  # Check if upload is processing or archive copy is being written
+  def pending ( self, spath ):
+    with self._lock:
+      return spath in self._archiving or spath in self._uploading
+
+  # Upload processed by Strava (called from the poller)
+  def uploaded ( self, ctx, state, status ):
+    tpath, spath, data, key, outs = ctx
+    if state == READY:
+      self.notify('Track', 'Uploaded : %s' % tpath)
+      metrics.count('tracks', stage='uploaded')
+    elif state == DUPLICATE:
+      log('sync: %s already on strava' % os.path.basename(tpath))
+      metrics.count('tracks', stage='duplicate')
+    if state in (READY, DUPLICATE):
+      self._dedup.add(os.path.basename(tpath), *key)
+      self.archive(spath, data, outs)
+    with self._lock:
+      self._uploading.discard(spath)
+    if state not in (READY, DUPLICATE):
+      log('sync: upload of %s failed (%s) %s' %\
+          (os.path.basename(tpath), state, status.get('error') or ''),
+          WARNING)
+      self.retry(tpath)
+
+  # Write archive copy and backups (dict format -> data, written alongside
+  # as <name>.<format>) in the background
+  def archive ( self, spath, data, backups = {} ):
+    with self._lock:
+      self._archiving.add(spath)
+
+    def write ():
+      try:
+        for fmt, d in backups.items():
+          bpath = os.path.splitext(spath)[0] + '.' + fmt
+          tmp   = bpath + '.tmp'
+          open(tmp, 'wb').write(d)
+          os.rename(tmp, bpath)
+        tmp  = spath + '.tmp'
+        fout = compress.open_write(tmp, self._conf['compress'])
+        try:
+          compress.copy(StringIO(data), fout)
+        finally:
+          fout.close()
+        os.rename(tmp, spath)
+      except Exception, e:
+        log('error archiving %s' % spath, ERROR, e=e)
+      finally:
+        with self._lock:
+          self._archiving.discard(spath)
+
+    threading.Thread(target=write, name='Archive').start()
+
+  # Wake the sync loop
+  def wake ( self ):
+    os.write(self._wake[1], 'x')
+
+  # Schedule retry of a failed track (exponential backoff)
+  def retry ( self, path ):
+    with self._lock:
+      if path in self._scheduled: return
+      self._scheduled.add(path)
+      n     = self._retries.get(path, 0)
+      delay = min(self._conf['retry_min'] * (2 ** n), self._conf['retry_max'])
+      self._retries[path] = n + 1
+      heapq.heappush(self._timers, (time.time() + delay, path))
+    metrics.count('retries')
+    log('sync: retry %s in %ds' % (os.path.basename(path), delay))
+    self.wake()
+
+  # Process a batch of files
+  def process ( self, paths ):
+    for p in sorted(paths):
+      profiling.begin('sync-' + os.path.splitext(os.path.basename(p))[0])
+      try:
+        ok = self.added(p)
+      finally:
+        profiling.end()
+      if ok:
+        with self._lock:
+          self._retries.pop(p, None)
+          self._keys.pop(p, None)
+      else:
+        self.retry(p)
+    metrics.gauge('retry_queue', len(self._timers))
+    metrics.export(self._conf)
+
+  # Scan (all cached tracks, bringing the index up to date)
   def scan ( self, tdir ):
-    ok = True
-    for f in os.listdir(tdir):
-      ok = ok and self.added(os.path.join(tdir, f))
-    return ok
+    names = self._tindex.reconcile(tdir)
+    self.process([ os.path.join(tdir, f) for f in names ])
 
   # Process files
   def run ( self ):
-    scan = False
     tdir = os.path.expanduser(self._conf['track_dir'])
+    wid  = self._id
+    mask = inotifyx.IN_CLOSE_WRITE | inotifyx.IN_MOVED_TO
 
     # Set up poll
     pd   = select.poll()
-    pd.register(self._id, select.POLLIN)
+    pd.register(wid, select.POLLIN)
+    pd.register(self._wake[0], select.POLLIN)
 
     # Scan existing files
-    scan = not self.scan(tdir)
+    self.scan(tdir)
 
-    # Wait for events
+    # Wait for events (or next retry)
     while self._run:
-      rs = pd.poll(3600000)
-
-      # Force scan
-      if scan:
-        scan = not self.scan(tdir)
-        continue
-
-      # Check for events
-      if not rs: continue
-      for (fd,ev) in rs:
-        if fd == self._id and ev & select.POLLIN:
-          es = inotifyx.get_events(self._id)
-          for e in es:
-            if not (e.mask & inotifyx.IN_CREATE): continue
-            p = os.path.join(tdir, e.name)
-            if not self.added(p):
-              scan = True
+      timeout = None
+      with self._lock:
+        if self._timers:
+          timeout = max(0, (self._timers[0][0] - time.time()) * 1000)
+      rs = pd.poll(timeout)
+
+      # Collect events, coalescing bursts
+      paths = set()
+      end   = time.time() + self._conf['sync_coalesce']
+      while rs and self._run:
+        for fd, ev in rs:
+          if fd != wid:
+            os.read(fd, 512)
+            continue
+          for e in inotifyx.get_events(wid):
+            if e.name and e.mask & mask:
+              paths.add(os.path.join(tdir, e.name))
+        wait = end - time.time()
+        rs   = wait > 0 and pd.poll(wait * 1000)
+
+      # Due retries
+      now = time.time()
+      with self._lock:
+        while self._timers and self._timers[0][0] <= now:
+          p = heapq.heappop(self._timers)[1]
+          self._scheduled.discard(p)
+          paths.add(p)
+
+      # Process
+      if paths and self._run:
+        self.process(paths)
+
+    os.close(wid)
     
 # ###########################################################################
 # Main
@@ -416,6 +692,8 @@ if __name__ == '__main__':
   conf = {
     'dev_path'      : '/dev/disk/by-id',
     'dev_regex'     : 'BRYTON',
+    'capture_dir'   : None,
+    'replay_latency': 0.0,
 
     'min_distance'  : 2.0,  # km
     'min_time'      : 300,  # sec
@@ -435,11 +713,47 @@ if __name__ == '__main__':
     'client_url'    : 'https://home.adamsutton.me.uk/brytonsync/auth_callback',
 
     'cookiepath'    : '~/.bryton/cookies.txt',
+    'watermark_file': '~/.bryton/watermarks.json',
+    'dedup_file'    : '~/.bryton/dedup.json',
+    'summary_file'  : '~/.bryton/summary.json',
+    'track_index'   : '~/.bryton/tracks.idx',
+    'spatial_index' : '~/.bryton/cells.idx',
+    'spatial_cell'  : 0.01, # degrees
+    'export_cache_dir'  : '~/.bryton/cache',
+    'export_cache_size' : 64 * 1024 * 1024,
+
+    'token_file'    : '~/.bryton/token',
+    'token_refresh_margin' : 300,
+    'api_url'       : None,
+    'http_pool_size': 4,
+    'http_timeout'  : 60.0,
+    'http_keepalive': True,
+    'rate_limits'   : [ 600, 30000 ],
+    'poll_min'      : 2.0,
+    'poll_max'      : 60.0,
+    'poll_timeout'  : 3600.0,
 
     'format'        : 'fit',
+    'backup_formats': [],   # e.g. [ 'gpx', 'tcx' ]
+    'compress'      : None, # gzip, zstd or lz4
+
+    'sync_coalesce' : 0.2,  # sec
+    'retry_min'     : 60,   # sec
+    'retry_max'     : 3600, # sec
+
+    'log_path'      : '/tmp/bryton-sync.log',
+    'log_level'     : 'info',
+    'log_max_size'  : 1048576, # bytes
+    'log_max_age'   : 86400,   # sec
+    'log_backups'   : 5,
+    'log_flush'     : 1.0,     # sec
+
+    'metrics_dir'   : '~/.bryton/metrics',
 
     'nosync'        : False,
     'nosend'        : False,
+    'resync'        : False,
+    'headless'      : False,
   }
 
   # Parse command line
@@ -453,6 +767,16 @@ if __name__ == '__main__':
                   help='Do not sync tracks to strava')
   optp.add_option('--nosend', default=False, action='store_true',
                   help='Fake the sync, but do not actually send')
+  optp.add_option('--resync', default=False, action='store_true',
+                  help='Ignore sync watermarks, check full device history')
+  optp.add_option('--headless', default=False, action='store_true',
+                  help='Run without GUI (requires a stored token)')
+  optp.add_option('--capture', default=None, metavar='DIR',
+                  help='Save raw device reads as images in DIR')
+  optp.add_option('--replay', default=None, metavar='DIR',
+                  help='Read device images from DIR instead of devices')
+  optp.add_option('--profile', default=None, metavar='DIR',
+                  help='Write per-track CPU/memory profiles to DIR')
   (opts,args) = optp.parse_args()
 
   # Load configuration
@@ -475,16 +799,48 @@ if __name__ == '__main__':
 
   if opts.nosync: conf['nosync'] = True
   if opts.nosend: conf['nosend'] = True
+  if opts.headless: conf['headless'] = True
+  if opts.resync: conf['resync'] = True
+  if opts.capture: conf['capture_dir'] = opts.capture
+  if opts.replay:
+    conf['dev_path']  = os.path.expanduser(opts.replay)
+    conf['dev_regex'] = re.escape(replay.EXT) + '$'
 
   # Fork
   if opts.fork: daemonise()
 
+  # Logging
+  log_configure(conf)
+
+  # Profiling
+  if opts.profile: profiling.configure(opts.profile)
+
+  # GTK
+  if not conf['headless']:
+    import gi
+    gi.require_version('Gtk', '3.0')
+    from gi.repository import Gtk, Gdk
+
   # Start
   b = BrytonSync(conf)
   b.start()
 
-  # Start GTK main thread
+  # Startup stats
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  log('started in %.2fs (maxrss=%dkB)' % (time.time() - START, rss))
+
+  # Headless (wait for signal)
   import signal
+  if conf['headless']:
+    def quit ( sig, frame ):
+      b.stop()
+    signal.signal(signal.SIGINT,  quit)
+    signal.signal(signal.SIGTERM, quit)
+    while b._run:
+      signal.pause()
+    sys.exit(0)
+
+  # Start GTK main thread
   signal.signal(signal.SIGINT, signal.SIG_DFL)
   Gdk.threads_init()
 
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+#
+# compress.py - Transparent stream compression
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, time
+import gzip
+
+# Optional codecs
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+try:
+  import lz4.frame
+except ImportError:
+  lz4 = None
+
+# ###########################################################################
+# Codecs
+# ###########################################################################
+
+CHUNK  = 65536
+
+MAGICS = [
+  ('gzip', '\x1f\x8b'),
+  ('zstd', '\x28\xb5\x2f\xfd'),
+  ('lz4',  '\x04\x22\x4d\x18'),
+]
+
+#
+# List available codecs
+#
+def codecs ():
+  ret = [ 'gzip' ]
+  if zstandard: ret.append('zstd')
+  if lz4:       ret.append('lz4')
+  return ret
+
+#
+# Detect codec from leading bytes (None if uncompressed)
+#
+def detect ( data ):
+  for c, m in MAGICS:
+    if data.startswith(m): return c
+  return None
+
+#
+# Wrap an open file object for compressed writing
+#
+def writer ( fp, codec ):
+  if not codec:
+    return fp
+  if codec == 'gzip':
+    return gzip.GzipFile(fileobj=fp, mode='wb', compresslevel=6)
+  if codec == 'zstd' and zstandard:
+    return zstandard.ZstdCompressor().stream_writer(fp)
+  if codec == 'lz4' and lz4:
+    return lz4.frame.LZ4FrameFile(fp, mode='wb')
+  raise ValueError('compression codec %s not available' % codec)
+
+#
+# Wrap an open file object for decompressed reading
+#
+def reader ( fp, codec ):
+  if not codec:
+    return fp
+  if codec == 'gzip':
+    return gzip.GzipFile(fileobj=fp, mode='rb')
+  if codec == 'zstd' and zstandard:
+    return zstandard.ZstdDecompressor().stream_reader(fp)
+  if codec == 'lz4' and lz4:
+    return lz4.frame.LZ4FrameFile(fp, mode='rb')
+  raise ValueError('compression codec %s not available' % codec)
+
+# ###########################################################################
+# File access
+# ###########################################################################
+
+#
+# Compressed file wrapper
+#
+# Closes both the codec stream and the underlying file
+#
+class File:
+
+  def __init__ ( self, fp, stream ):
+    self._fp     = fp
+    self._stream = stream
+
+  # Note: unlike some codec streams, always returns n bytes unless at EOF
+  def read ( self, n = -1 ):
+    if n < 0:
+      return self._stream.read()
+    ret = []
+    while n > 0:
+      data = self._stream.read(n)
+      if not data: break
+      ret.append(data)
+      n -= len(data)
+    return ''.join(ret)
+
+  def write ( self, data ):
+    return self._stream.write(data)
+
+  def close ( self ):
+    if self._stream is not self._fp:
+      self._stream.close()
+    if not self._fp.closed:
+      self._fp.close()
+
+#
+# Open file for writing, compressed using codec (None for no compression)
+#
+def open_write ( path, codec = None ):
+  fp = open(path, 'wb')
+  return File(fp, writer(fp, codec))
+
+#
+# Open file for reading, compression is detected automatically
+#
+def open_read ( path ):
+  fp    = open(path, 'rb')
+  codec = detect(fp.read(4))
+  fp.seek(0)
+  return File(fp, reader(fp, codec))
+
+#
+# Check whether a file is compressed
+#
+def compressed ( path ):
+  fp = open(path, 'rb')
+  try:
+    return detect(fp.read(4)) is not None
+  finally:
+    fp.close()
+
+#
+# Copy between file objects chunk by chunk
+#
+def copy ( fin, fout ):
+  n = 0
+  while True:
+    data = fin.read(CHUNK)
+    if not data: break
+    fout.write(data)
+    n += len(data)
+  return n
+
+# ###########################################################################
+# Main
+# ###########################################################################
+
+if __name__ == '__main__':
+  from optparse import OptionParser
+  from StringIO import StringIO
+
+  # In memory output (codecs close their output on completion)
+  class Buffer ( StringIO ):
+    def close ( self ): pass
+
+  # Command line
+  optp = OptionParser(usage='%prog [options] file ...')
+  optp.add_option('-c', '--codec', default=[], action='append',
+                  help='Codec to test (default all available)')
+  (opts, args) = optp.parse_args()
+
+  # Load files
+  raw = ''.join(open(os.path.expanduser(a), 'rb').read() for a in args)
+  if not raw:
+    optp.error('no input data')
+  mb  = len(raw) / 1048576.0
+
+  # Report
+  print '%-6s %10s %10s %7s %10s %10s' %\
+        ('codec', 'in', 'out', 'ratio', 'enc MB/s', 'dec MB/s')
+  for c in opts.codec or codecs():
+
+    # Encode
+    t0  = time.time()
+    out = Buffer()
+    w   = writer(out, c)
+    copy(StringIO(raw), w)
+    w.close()
+    enc = out.getvalue()
+    t1  = time.time()
+
+    # Decode
+    copy(reader(StringIO(enc), c), Buffer())
+    t2  = time.time()
+
+    print '%-6s %10d %10d %7.2f %10.1f %10.1f' %\
+          (c, len(raw), len(enc), float(len(raw)) / max(len(enc), 1),
+           mb / max(t1 - t0, 1e-6), mb / max(t2 - t1, 1e-6))
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
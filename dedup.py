@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#
+# dedup.py - Content based duplicate detection
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, json, struct, hashlib
+import threading
+
+# Local
+import track
+from log import log
+
+# ###########################################################################
+# Hashing
+# ###########################################################################
+
+#
+# Channel precision used when hashing (values are rounded so that the same
+# ride hashes the same however it was read, converted or stored)
+#
+PRECISION = [
+  ('timestamp',   1),
+  ('latitude',    1e5),
+  ('longitude',   1e5),
+  ('altitude',    10),
+  ('temperature', 10),
+  ('heartrate',   1),
+  ('cadence',     1),
+  ('speed',       100),
+  ('distance',    1000),
+]
+
+MISSING = -(1 << 62)
+
+#
+# Stable content hash of the normalised track data
+#
+def content_hash ( t ):
+  h   = hashlib.sha1()
+  pts = t['track']
+  h.update('static=%d;count=%d;' % (bool(t['static']), len(pts)))
+  for k, m in PRECISION:
+    vals = [ int(round(p[k] * m)) if k in p else MISSING for p in pts ]
+    h.update(k)
+    h.update(struct.pack('<%dq' % len(vals), *vals))
+  return h.hexdigest()
+
+#
+# Fingerprint of ride timing and route (for near duplicates, e.g. the same
+# ride recorded by two devices, with different sample rates and cropping)
+#
+# Route samples are taken at absolute time boundaries (every STEP seconds
+# UTC), so two recordings of the same ride sample the same instants, the
+# nearest point within GAP seconds is used. Static rides keep the distance
+# instead.
+#
+STEP   = 300   # seconds between route samples
+GAP    = 30    # seconds, max distance in time of a sample point
+WINDOW = 600   # seconds, max difference in start (and end) time
+NEAR   = 0.5   # km, sample positions this close agree
+AGREE  = 0.8   # fraction of common samples that must agree
+
+def fingerprint ( t ):
+  pts = t['track']
+  if not pts: return None
+  ret = {
+    'start'    : pts[0]['timestamp'],
+    'end'      : pts[-1]['timestamp'],
+    'static'   : bool(t['static']),
+    'distance' : pts[-1].get('distance', 0.0) if t['static'] else None,
+    'route'    : [],
+  }
+  if t['static']: return ret
+
+  # Sample positions
+  pos  = [ p for p in pts if 'latitude' in p ]
+  i    = 0
+  ts   = (int(ret['start']) // STEP + 1) * STEP
+  while pos and ts <= ret['end']:
+    while i + 1 < len(pos) and pos[i + 1]['timestamp'] <= ts:
+      i += 1
+    best = min(pos[i:i + 2], key=lambda p: abs(p['timestamp'] - ts))
+    if abs(best['timestamp'] - ts) <= GAP:
+      ret['route'].append([ ts, round(best['latitude'], 5),
+                                round(best['longitude'], 5) ])
+    ts += STEP
+  return ret
+
+#
+# Check whether two fingerprints are (probably) the same ride
+#
+def match ( a, b ):
+  if a['static'] != b['static']: return False
+  if abs(a['start'] - b['start']) > WINDOW: return False
+  if abs(a['end']   - b['end'])   > WINDOW: return False
+
+  # Static, compare distance
+  if a['static']:
+    da, db = a['distance'] or 0.0, b['distance'] or 0.0
+    return abs(da - db) <= max(0.5, 0.05 * max(da, db))
+
+  # Positions at the same instants
+  ra     = dict((s[0], s[1:]) for s in a['route'])
+  common = [ (ra[s[0]], s[1:]) for s in b['route'] if s[0] in ra ]
+  if not common: return False
+  if len(common) * 2 < min(len(a['route']), len(b['route'])): return False
+  ok = 0
+  for (lat0, lon0), (lat1, lon1) in common:
+    if abs(track.haversine(lon0, lat0, lon1, lat1)) <= NEAR:
+      ok += 1
+  return ok >= AGREE * len(common)
+
+# ###########################################################################
+# Index
+# ###########################################################################
+
+#
+# Persistent index of synced content hashes and fingerprints
+#
+# Stored as an append-only file of JSON lines, one per synced track
+# (older versions stored a single JSON object, which is converted keeping
+# the hashes)
+#
+class DedupIndex:
+
+  def __init__ ( self, path ):
+    self._path   = os.path.expanduser(path)
+    self._lock   = threading.Lock()
+    self._hashes = {} # hash -> name
+    self._prints = {} # start bucket -> [ (name, fingerprint) ]
+    legacy       = None
+    try:
+      for l in open(self._path):
+        try:
+          e = json.loads(l)
+        except ValueError, err:
+          log('dedup: ignoring corrupt entry in %s [e=%s]' %\
+              (self._path, err))
+          continue
+        if 'hashes' in e:
+          legacy = e['hashes']
+        else:
+          self._insert(e['name'], e['hash'], e.get('print'))
+    except IOError:
+      pass
+
+    # Convert older index (hashes only, the fingerprints are not compatible)
+    if legacy:
+      self._hashes.update(legacy)
+      tmp = self._path + '.tmp'
+      open(tmp, 'w').write(''.join(json.dumps({ 'name' : n, 'hash' : h,
+                                                'print' : None }) + '\n'
+                                   for h, n in legacy.items()))
+      os.rename(tmp, self._path)
+      log('dedup: converted %s (%d hashes)' % (self._path, len(legacy)))
+
+  # Add entry to memory
+  def _insert ( self, name, h, fp ):
+    self._hashes[h] = name
+    if fp:
+      b = int(fp['start'] // WINDOW)
+      self._prints.setdefault(b, []).append((name, fp))
+
+  #
+  # Find synced track matching hash (exact) or fingerprint (near)
+  #
+  # Returns (kind, name) or None
+  #
+  def lookup ( self, h, fp ):
+    with self._lock:
+      if h in self._hashes:
+        return ('exact', self._hashes[h])
+      if not fp: return None
+      b = int(fp['start'] // WINDOW)
+      for x in (b, b - 1, b + 1):
+        for n, o in self._prints.get(x, []):
+          if match(fp, o):
+            return ('near', n)
+    return None
+
+  #
+  # Record synced track
+  #
+  def add ( self, name, h, fp ):
+    with self._lock:
+      self._insert(name, h, fp)
+      d = os.path.dirname(self._path)
+      if d and not os.path.exists(d):
+        os.makedirs(d)
+      out = open(self._path, 'a')
+      try:
+        out.write(json.dumps({ 'name' : name, 'hash' : h, 'print' : fp })
+                  + '\n')
+      finally:
+        out.close()
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
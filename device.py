@@ -32,6 +32,7 @@ sys.path.insert(0, 'bryton-gps-linux/code')
 from device_access import DeviceAccess
 from brytongps     import get_device
 from log           import log
+from replay        import Recorder, ReplayAccess, is_image, EXT
 
 # ###########################################################################
 # Device Access
@@ -42,10 +43,18 @@ from log           import log
 #
 class Device:
 
-  def __init__ ( self, mod, dev ):
-    self._mod = mod
-    self._dev = dev
-    self._ser = None
+  def __init__ ( self, mod, dev, cancel = None ):
+    self._mod    = mod
+    self._dev    = dev
+    self._ser    = None
+    self._cancel = cancel or threading.Event()
+
+  # Device removed (abort any processing)
+  def cancel ( self ):
+    self._cancel.set()
+
+  def cancelled ( self ):
+    return self._cancel.is_set()
 
   def get_product ( self ):
     return 'Rider 40'
@@ -61,6 +70,27 @@ class Device:
   def get_history ( self ):
     return self._mod.read_history(self._dev)
 
+  # Iterate history, newest first
+  #
+  # The ride summaries are read immediately, but each ride is released
+  # once the caller moves on, so any segment data it loaded can be freed
+  # before the next ride is read
+  #
+  def history ( self ):
+    hist = self.get_history()
+    if not hasattr(hist, '__getitem__'):
+      hist = list(hist)
+    def iterate ():
+      for i in xrange(len(hist) - 1, -1, -1):
+        h, hist[i] = hist[i], None
+        yield h
+        h = None
+    return iterate()
+
+  # Merged segments of a ride (lists of (track point, log point))
+  def segments ( self, h ):
+    return h.merged_segments(True)
+
 #
 # Class to monitor for valid devices and return handles
 #
@@ -75,7 +105,10 @@ class DeviceMonitor (threading.Thread):
     self._conf = conf
     self._add  = add
     self._rem  = rem
-    self._dev  = {}
+    self._lock = threading.Lock()
+    self._dev  = {} # path -> Device
+    self._busy = {} # path -> (worker thread, cancel event)
+    self._again = set() # paths re-plugged while their worker was busy
 
   # Start
   def start ( self ):
@@ -83,7 +116,9 @@ class DeviceMonitor (threading.Thread):
     self._run = True
     self._id = inotifyx.init()
     self._wd = inotifyx.add_watch(self._id, self._conf['dev_path'],
-                                  inotifyx.IN_CREATE | inotifyx.IN_DELETE)
+                                  inotifyx.IN_CREATE | inotifyx.IN_DELETE |
+                                  inotifyx.IN_MOVED_TO |
+                                  inotifyx.IN_MOVED_FROM)
     threading.Thread.start(self)
   
   # Stop
@@ -94,26 +129,93 @@ class DeviceMonitor (threading.Thread):
     os.close(self._id)
     self._id  = None
     self._wd  = None
+    with self._lock:
+      for w, c in self._busy.values():
+        c.set()
 
-  # Handle new device
+  # Handle new device (processed in its own worker thread)
   def added ( self, path ):
     if not os.access(path, os.R_OK | os.W_OK):
       return
     log('device: added %s' % path)
-    deva    = DeviceAccess(path)
+    with self._lock:
+      if path in self._busy:
+        log('device: %s still being read, will re-read when done' % path)
+        self._again.add(path)
+        return
+      c = threading.Event()
+      w = threading.Thread(target=self.worker, args=(path, c),
+                           name='DevWorker-%s' % os.path.basename(path))
+      w.daemon = True
+      self._busy[path] = (w, c)
+    w.start()
+
+  # Open device (or replay a captured image)
+  def access ( self, path ):
+    if is_image(path):
+      log('device: replaying %s' % path)
+      deva = ReplayAccess(path, self._conf.get('replay_latency', 0.0))
+    else:
+      deva = DeviceAccess(path)
     deva.open()
-    mod,dev = get_device(deva)
-    d       = Device(mod, dev)
-    self._dev[path] = d
-    self._add(d)
+    if self._conf.get('capture_dir'):
+      deva = Recorder(deva)
+    return deva
+
+  # Save raw reads to capture_dir
+  def capture ( self, path, deva ):
+    d = os.path.expanduser(self._conf['capture_dir'])
+    try:
+      if not os.path.exists(d):
+        os.makedirs(d)
+      p = os.path.join(d, '%s-%d%s' % (os.path.basename(path),
+                                       int(time.time()), EXT))
+      deva.save(p)
+      log('device: captured %d reads to %s' % (len(deva), p))
+    except Exception, e:
+      log('device: failed to capture %s [e=%s]' % (path, e))
+
+  # Device worker
+  def worker ( self, path, cancel ):
+    deva = None
+    try:
+      deva    = self.access(path)
+      mod,dev = get_device(deva)
+      d       = Device(mod, dev, cancel)
+      with self._lock:
+        if cancel.is_set(): return
+        self._dev[path] = d
+      self._add(d)
+    except Exception, e:
+      if cancel.is_set():
+        log('device: %s removed during read' % path)
+      else:
+        log('device: error reading %s [e=%s]' % (path, e))
+    finally:
+      if isinstance(deva, Recorder) and len(deva):
+        self.capture(path, deva)
+      if deva:
+        try:
+          deva.close()
+        except: pass
+      with self._lock:
+        self._busy.pop(path, None)
+        again = path in self._again and self._run
+        self._again.discard(path)
+      if again:
+        self.added(path)
 
   # Removed
   def removed ( self, path ):
     log('device: removed %s' % path)
-    if path in self._dev:
-      d = self._dev[path]
+    with self._lock:
+      if path in self._busy:
+        self._busy[path][1].set()
+      self._again.discard(path)
+      d = self._dev.pop(path, None)
+    if d:
+      d.cancel()
       if self._rem: self._rem(d)
-      del self._dev[path]
 
   # Check for existing devices
   def scan ( self, path, exp ):
@@ -142,11 +244,13 @@ class DeviceMonitor (threading.Thread):
           try:
             es = inotifyx.get_events(self._id)
             for e in es:
-              if not (e.mask & inotifyx.IN_CREATE | inotifyx.IN_DELETE):
+              if not (e.mask & (inotifyx.IN_CREATE | inotifyx.IN_DELETE |
+                                inotifyx.IN_MOVED_TO |
+                                inotifyx.IN_MOVED_FROM)):
                 continue
               p = os.path.join(path, e.name)
               if not exp.search(p): continue
-              if e.mask & inotifyx.IN_CREATE:
+              if e.mask & (inotifyx.IN_CREATE | inotifyx.IN_MOVED_TO):
                 self.added(p)
               else:
                 self.removed(p)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+# export.py - Single pass, multi-format activity export
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+import time, datetime
+
+# Local
+from track import haversine
+
+# ###########################################################################
+# Conversions
+# ###########################################################################
+
+#
+# ISO 8601 time (GPX/TCX)
+#
+def time2isoformat ( t ):
+  return datetime.datetime.utcfromtimestamp(int(t)).isoformat() + 'Z'
+
+#
+# FIT timestamp (seconds since 1989-12-31)
+#
+def time2timestamp ( tm ):
+  return int(tm - 631065600)
+
+#
+# FIT position
+#
+def deg2semicircle ( deg ):
+  sc  = deg / 180.0
+  sc *= (2 ** 31)
+  return int(sc)
+
+#
+# km/h to m/s
+#
+def kph2mps ( kph ):
+  mps = (kph / 3.6)
+  return mps
+
+# ###########################################################################
+# Engine
+# ###########################################################################
+
+#
+# Shared per point values (a sink lists those it uses in NEEDS)
+#
+#   iso      - ISO 8601 time
+#   fit_time - FIT timestamp
+#   semi     - (latitude, longitude) in semicircles (not static)
+#   mps      - speed in m/s (if speed present)
+#   dist     - cumulative distance in metres
+#
+# A sink has begin(first point, static), point(p, shared) and end(), which
+# returns the encoded data
+#
+
+#
+# Walk the track once, feeding every sink, returns the data from each
+#
+def run ( track, static, sinks ):
+  needs = set()
+  for s in sinks:
+    needs |= s.NEEDS
+  iso   = 'iso'      in needs
+  fitt  = 'fit_time' in needs
+  semi  = 'semi'     in needs and not static
+  mps   = 'mps'      in needs
+  dist  = 'dist'     in needs
+  feed  = [ s.point for s in sinks ]
+
+  for s in sinks:
+    s.begin(track[0], static)
+
+  d    = 0.0
+  prev = None
+  for p in track:
+    c = {}
+    if iso:
+      c['iso']      = time2isoformat(p['timestamp'])
+    if fitt:
+      c['fit_time'] = time2timestamp(p['timestamp'])
+    if semi:
+      c['semi']     = (deg2semicircle(p['latitude']),
+                       deg2semicircle(p['longitude']))
+    if mps and 'speed' in p:
+      c['mps']      = kph2mps(p['speed'])
+    if dist:
+      if static:
+        d = p['distance'] * 1000 if 'distance' in p else d
+      elif prev is not None:
+        d += abs(haversine(prev['longitude'], prev['latitude'],
+                           p['longitude'], p['latitude'])) * 1000
+      c['dist'] = d
+      prev      = p
+    for f in feed:
+      f(p, c)
+
+  return [ s.end() for s in sinks ]
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
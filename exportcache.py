@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+# exportcache.py - Cache of encoded activity files
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, time
+import threading
+
+# Local
+import metrics, export
+import fit, gpx2, tcx
+from log import log
+
+# ###########################################################################
+# Encoders
+# ###########################################################################
+
+ENCODERS = {
+  'fit' : (fit.FitSink,  fit.VERSION),
+  'gpx' : (gpx2.GpxSink, gpx2.VERSION),
+  'tcx' : (tcx.TcxSink,  tcx.VERSION),
+}
+
+# ###########################################################################
+# Cache
+# ###########################################################################
+
+#
+# Size bounded (LRU) on-disk cache of encoded activities
+#
+# Entries are keyed by track content hash, format and encoder version, so
+# a changed track or encoder never returns stale data
+#
+class ExportCache:
+
+  def __init__ ( self, path, max_size ):
+    self._path  = os.path.expanduser(path)
+    self._max   = max_size
+    self._lock  = threading.Lock()
+    self._used  = {} # name -> [ last used, size ]
+    self._size  = 0
+    if not os.path.exists(self._path):
+      os.makedirs(self._path)
+    for f in os.listdir(self._path):
+      if f.endswith('.tmp'): continue
+      st = os.stat(os.path.join(self._path, f))
+      self._used[f] = [ st.st_mtime, st.st_size ]
+      self._size   += st.st_size
+
+  # Entry name
+  def _name ( self, h, fmt ):
+    return '%s-v%d.%s' % (h, ENCODERS[fmt][1], fmt)
+
+  #
+  # Get cached data (or None)
+  #
+  def get ( self, h, fmt ):
+    n = self._name(h, fmt)
+    p = os.path.join(self._path, n)
+    with self._lock:
+      if n not in self._used:
+        metrics.count('export_cache', result='miss')
+        return None
+      self._used[n][0] = time.time()
+    try:
+      data = open(p, 'rb').read()
+      os.utime(p, None)
+    except (IOError, OSError):
+      with self._lock:
+        e = self._used.pop(n, None)
+        if e: self._size -= e[1]
+      metrics.count('export_cache', result='miss')
+      return None
+    metrics.count('export_cache', result='hit')
+    return data
+
+  #
+  # Store data, evicting least recently used entries to stay within size
+  #
+  def put ( self, h, fmt, data ):
+    n   = self._name(h, fmt)
+    p   = os.path.join(self._path, n)
+    tmp = p + '.tmp'
+    try:
+      open(tmp, 'wb').write(data)
+      os.rename(tmp, p)
+    except (IOError, OSError), e:
+      log('export cache: failed to write %s [e=%s]' % (n, e))
+      return
+    with self._lock:
+      old = self._used.get(n)
+      if old: self._size -= old[1]
+      self._used[n] = [ time.time(), len(data) ]
+      self._size   += len(data)
+      evict = []
+      if self._size > self._max:
+        for t, f in sorted((e[0], f) for f, e in self._used.items()):
+          if self._size <= self._max: break
+          if f == n: continue
+          self._size -= self._used.pop(f)[1]
+          evict.append(f)
+    for f in evict:
+      try:
+        os.unlink(os.path.join(self._path, f))
+      except OSError: pass
+    metrics.gauge('export_cache_bytes', self._size)
+
+  #
+  # Get encoded activity, encoding (and caching) it if required
+  #
+  # load() is only called on a cache miss
+  #
+  def encode ( self, h, fmt, load ):
+    return self.encode_all(h, [ fmt ], load)[fmt]
+
+  #
+  # Get several encoded formats (dict format -> data)
+  #
+  # Cache misses are all encoded in a single pass over the track, so
+  # load() is called at most once
+  #
+  def encode_all ( self, h, fmts, load ):
+    ret  = {}
+    miss = []
+    for fmt in fmts:
+      data = self.get(h, fmt)
+      if data is None:
+        miss.append(fmt)
+      else:
+        ret[fmt] = data
+    if miss:
+      t    = load()
+      outs = export.run(t['track'], t['static'],
+                        [ ENCODERS[fmt][0]() for fmt in miss ])
+      for fmt, data in zip(miss, outs):
+        self.put(h, fmt, data)
+        ret[fmt] = data
+    return ret
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
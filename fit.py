@@ -34,21 +34,12 @@ sys.path.insert(0, d + '/python-fitparse')
 from fitparse.profile import MESSAGE_TYPES, FIELD_TYPES
 from fitparse.utils   import calc_crc
 
-# ###########################################################################
-# FIT type conversion
-# ###########################################################################
-
-def time2timestamp ( tm ):
-  return int(tm - 631065600)
+# Local
+import export
+from export import time2timestamp, deg2semicircle, kph2mps
 
-def deg2semicircle ( deg ):
-  sc  = deg / 180.0
-  sc *= (2 ** 31)
-  return int(sc)
-
-def kph2mps ( kph ):
-  mps = (kph / 3.6)
-  return mps
+# Encoder version (bump whenever the output changes, see exportcache.py)
+VERSION = 1
 
 # ###########################################################################
 # FIT file generation
@@ -116,31 +107,29 @@ def fit_crc ( data ):
   return struct.pack('<H', calc_crc(data, 0))
 
 #
-# Generate activity file
+# Activity sink (see export.py)
 #
-def fit_activity ( track, static = False ):
-  lmsg = 0
-  data = ''
+class FitSink:
 
-  # Create records (TODO: dynamic field list)
-  rec_fields = [ 'timestamp', 'heart_rate', 'cadence', 'speed' ]
-  if not static:
-    rec_fields.extend(['position_lat', 'position_long', 'altitude', 'temperature'])
-  else:
-    rec_fields.extend(['distance'])
-  rec_data   = []
-  for p in track:
+  NEEDS = set([ 'fit_time', 'semi', 'mps' ])
+
+  def begin ( self, first, static ):
+    self._static = static
+    self._start  = time2timestamp(first['timestamp'])
+    self._rows   = []
+
+  def point ( self, p, c ):
     r = [
-          time2timestamp(p['timestamp']),
+          c['fit_time'],
           p['heartrate']      if 'heartrate'   in p else 0,
           p['cadence']        if 'cadence'     in p else 0,
-          kph2mps(p['speed']) if 'speed'       in p else 0
+          c['mps']            if 'speed'       in p else 0
         ]
-    if not static:
+    if not self._static:
       r.extend(
         [
-          deg2semicircle(p['latitude']), 
-          deg2semicircle(p['longitude']),
+          c['semi'][0],
+          c['semi'][1],
           p['altitude'],
           p['temperature']    if 'temperature' in p else 0,
         ])
@@ -149,45 +138,63 @@ def fit_activity ( track, static = False ):
         [
           p['distance'] * 1000 if 'distance'   in p else 0
         ])
-    rec_data.append(r)
-
-  # file_id
-  data += fit_msg(
-    local_msg  = lmsg,
-    msg_name   = 'file_id',
-    msg_fields = [
-      'type', 
-      'manufacturer',
-      ('product', 'garmin_product'),
-      'serial_number',
-      'time_created'
-    ],
-    msg_data   = [
-      [
-        'activity',
-        'garmin',
-        'edge500',
-        0x00000000,
-        time2timestamp(track[0]['timestamp']),
+    self._rows.append(r)
+
+  def end ( self ):
+    lmsg = 0
+    data = ''
+
+    # Record fields (TODO: dynamic field list)
+    rec_fields = [ 'timestamp', 'heart_rate', 'cadence', 'speed' ]
+    if not self._static:
+      rec_fields.extend(['position_lat', 'position_long', 'altitude', 'temperature'])
+    else:
+      rec_fields.extend(['distance'])
+
+    # file_id
+    data += fit_msg(
+      local_msg  = lmsg,
+      msg_name   = 'file_id',
+      msg_fields = [
+        'type', 
+        'manufacturer',
+        ('product', 'garmin_product'),
+        'serial_number',
+        'time_created'
       ],
-    ]
-  )
-  lmsg += 1
-  
-  # records
-  data += fit_msg(
-    local_msg  = lmsg,
-    msg_name   = 'record',
-    msg_fields = rec_fields,
-    msg_data   = rec_data
-  )
-  lmsg += 1
-  
-  # Add header/footer
-  data =  fit_hdr(data) + data
-  data += fit_crc(data)
+      msg_data   = [
+        [
+          'activity',
+          'garmin',
+          'edge500',
+          0x00000000,
+          self._start,
+        ],
+      ]
+    )
+    lmsg += 1
+    
+    # records
+    data += fit_msg(
+      local_msg  = lmsg,
+      msg_name   = 'record',
+      msg_fields = rec_fields,
+      msg_data   = self._rows
+    )
+    lmsg += 1
+    self._rows = None
+    
+    # Add header/footer
+    data =  fit_hdr(data) + data
+    data += fit_crc(data)
+
+    return data
 
-  return data
+#
+# Generate activity file
+#
+def fit_activity ( track, static = False ):
+  return export.run(track, static, [ FitSink() ])[0]
 
 # ###########################################################################
 # Test
@@ -198,19 +205,27 @@ def fit_activity ( track, static = False ):
 # ###########################################################################
 
 if __name__ == '__main__':
-  import json
   from optparse import OptionParser
+  import trackfile, profiling
 
   # Command line
   optp = OptionParser()
+  optp.add_option('--profile', default=None, metavar='DIR',
+                  help='Write CPU/memory profile to DIR')
   (opts, args) = optp.parse_args()
+  if opts.profile:
+    profiling.configure(opts.profile)
+    profiling.begin(os.path.splitext(os.path.basename(args[0]))[0])
   #print opts, args
 
   # Load track
-  track = json.loads(open(args[0]).read())
+  with profiling.stage('load'):
+    track = trackfile.load(args[0])
 
   # Convert to FIT
-  fit   = fit_activity(track)
+  with profiling.stage('encode_fit'):
+    fit = fit_activity(track['track'], track['static'])
+  profiling.end()
 
   # Output to file
   if len(args) > 1:
@@ -23,40 +23,44 @@
 
 import time, datetime
 
+# Local
+import export
+from export import time2isoformat
+
+# Encoder version (bump whenever the output changes, see exportcache.py)
+VERSION = 1
+
 # ###########################################################################
 # Functions
 # ###########################################################################
 
 #
-# Convert time
-#
-def time2isoformat ( t ):
-  return datetime.datetime.utcfromtimestamp(int(t)).isoformat() + 'Z'
-
-#
-# Output GPX activity
+# GPX activity sink (see export.py)
 #
+class GpxSink:
 
-def gpx_activity ( track, static = False ):
+  NEEDS = set([ 'iso' ])
 
-  # Header
-  gpx = '<?xml version="1.0" encoding="UTF-8" standalone="no" ?>\n'
-  gpx += '<gpx xmlns="http://www.topografix.com/GPX/1/1" xmlns:gpxx="http://www.garmin.com/xmlschemas/GpxExtensions/v3" xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1" creator="Oregon 400t" version="1.1" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd http://www.garmin.com/xmlschemas/GpxExtensions/v3 http://www.garmin.com/xmlschemas/GpxExtensionsv3.xsd http://www.garmin.com/xmlschemas/TrackPointExtension/v1 http://www.garmin.com/xmlschemas/TrackPointExtensionv1.xsd">\n'
-  gpx += '  <metadata>\n'
-  gpx += '    <time>%s</time>\n' % time2isoformat(track[0]['timestamp'])
-  gpx += '  </metadata>\n'
+  def begin ( self, first, static ):
 
-  # Track Begin
-  gpx += '  <trk>\n'
-  gpx += '    <name>GPX Backup of FIT</name>\n'
-  gpx += '    <trkseg>\n'
+    # Header
+    gpx = '<?xml version="1.0" encoding="UTF-8" standalone="no" ?>\n'
+    gpx += '<gpx xmlns="http://www.topografix.com/GPX/1/1" xmlns:gpxx="http://www.garmin.com/xmlschemas/GpxExtensions/v3" xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1" creator="Oregon 400t" version="1.1" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd http://www.garmin.com/xmlschemas/GpxExtensions/v3 http://www.garmin.com/xmlschemas/GpxExtensionsv3.xsd http://www.garmin.com/xmlschemas/TrackPointExtension/v1 http://www.garmin.com/xmlschemas/TrackPointExtensionv1.xsd">\n'
+    gpx += '  <metadata>\n'
+    gpx += '    <time>%s</time>\n' % time2isoformat(first['timestamp'])
+    gpx += '  </metadata>\n'
 
+    # Track Begin
+    gpx += '  <trk>\n'
+    gpx += '    <name>GPX Backup of FIT</name>\n'
+    gpx += '    <trkseg>\n'
+    self._out = [ gpx ]
 
-  # Track points
-  for p in track:
-    gpx += '      <trkpt lat="%0.6f" lon="%0.6f">\n' % (p['latitude'], p['longitude'])
+  # Track point
+  def point ( self, p, c ):
+    gpx  = '      <trkpt lat="%0.6f" lon="%0.6f">\n' % (p['latitude'], p['longitude'])
     gpx += '        <ele>%0.6f</ele>\n' % p['altitude']
-    gpx += '        <time>%s</time>\n' % time2isoformat(p['timestamp'])
+    gpx += '        <time>%s</time>\n' % c['iso']
     gpx += '        <extensions>\n'
     gpx += '          <gpxtpx:TrackPointExtension>\n'
     if 'cadence' in p:
@@ -70,32 +74,51 @@ def gpx_activity ( track, static = False ):
     gpx += '          </gpxtpx:TrackPointExtension>\n'
     gpx += '        </extensions>\n'
     gpx += '      </trkpt>\n'  
+    self._out.append(gpx)
 
   # Track End / Footer
-  gpx += '    </trkseg>\n'
-  gpx += '  </trk>\n'
-  gpx += '</gpx>\n'
+  def end ( self ):
+    gpx  = '    </trkseg>\n'
+    gpx += '  </trk>\n'
+    gpx += '</gpx>\n'
+    self._out.append(gpx)
+    ret, self._out = ''.join(self._out), None
+    return ret
+
+#
+# Output GPX activity
+#
 
-  return gpx
+def gpx_activity ( track, static = False ):
+  return export.run(track, static, [ GpxSink() ])[0]
 
 # ###########################################################################
 # Main
 # ###########################################################################
 
 if __name__ == '__main__':
-  import json
   from optparse import OptionParser
+  import os
+  import trackfile, profiling
 
   # Command line
   optp = OptionParser()
+  optp.add_option('--profile', default=None, metavar='DIR',
+                  help='Write CPU/memory profile to DIR')
   (opts, args) = optp.parse_args()
+  if opts.profile:
+    profiling.configure(opts.profile)
+    profiling.begin(os.path.splitext(os.path.basename(args[0]))[0])
   #print opts, args
 
   # Load track
-  track = json.loads(open(args[0]).read())
+  with profiling.stage('load'):
+    track = trackfile.load(args[0])
 
   # Convert to GPX
-  gpx   = gpx_activity(track)
+  with profiling.stage('encode_gpx'):
+    gpx = gpx_activity(track['track'], track['static'])
+  profiling.end()
 
   # Output to file
   if len(args) > 1:
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+# loadtest.py - Upload load test (against stravastub.py)
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, time, tempfile, shutil
+import threading, Queue
+from optparse import OptionParser
+
+# Path
+d = os.path.dirname(sys.argv[0]) or '.'
+sys.path.insert(0, d + '/python-fitparse')
+sys.path.insert(0, d + '/stravalib')
+
+# Local
+import track, stravastub
+from bench      import synth_segments
+from fit        import fit_activity
+from stravasync import Strava
+from log        import log_configure
+
+# ###########################################################################
+# Helpers
+# ###########################################################################
+
+#
+# Authentication backend that always succeeds (stub accepts any token)
+#
+class StubAuth:
+  def authenticate ( self ):
+    return 'stub-token'
+
+#
+# Percentile of sorted values
+#
+def percentile ( vals, p ):
+  if not vals: return 0.0
+  i = min(len(vals) - 1, int(round(p / 100.0 * (len(vals) - 1))))
+  return vals[i]
+
+#
+# Push n uploads through the uploader using j threads
+#
+def run ( strava, data, n, j ):
+  jobs  = Queue.Queue()
+  lock  = threading.Lock()
+  lats  = []
+  fails = [ 0 ]
+  for i in range(n):
+    jobs.put(i)
+
+  def worker ():
+    while True:
+      try:
+        jobs.get_nowait()
+      except Queue.Empty:
+        return
+      t0 = time.time()
+      ok = strava.send_activity(data, 'fit')
+      dt = time.time() - t0
+      with lock:
+        lats.append(dt)
+        if not ok: fails[0] += 1
+
+  t0 = time.time()
+  ts = [ threading.Thread(target=worker) for i in range(j) ]
+  for t in ts: t.start()
+  for t in ts: t.join()
+  return time.time() - t0, sorted(lats), fails[0]
+
+# ###########################################################################
+# Main
+# ###########################################################################
+
+if __name__ == '__main__':
+
+  # Command line
+  optp = OptionParser(usage='%prog [options]')
+  optp.add_option('-n', '--uploads', default=1000, type='int',
+                  help='Number of uploads')
+  optp.add_option('-j', '--jobs', default=8, type='int',
+                  help='Concurrent uploaders')
+  optp.add_option('-u', '--url', default=None,
+                  help='Use an already running stub (default start one)')
+  optp.add_option('-l', '--latency', default='0', metavar='MIN[,MAX]',
+                  help='Stub response latency in seconds')
+  optp.add_option('-e', '--error-rate', default=0.0, type='float',
+                  help='Stub fraction of requests failing with 500')
+  optp.add_option('-p', '--pool', default=None, type='int',
+                  help='HTTP connection pool size (default jobs)')
+  optp.add_option('--no-keepalive', default=False, action='store_true',
+                  help='Open a new connection for every request')
+  optp.add_option('-s', '--size', default=1.0, type='float',
+                  help='Ride duration (hours) of the uploaded activity')
+  (opts, args) = optp.parse_args()
+
+  tmp = tempfile.mkdtemp(prefix='bryton-loadtest-')
+  try:
+    conf = {
+      'headless'       : True,
+      'token_file'     : os.path.join(tmp, 'token'),
+      'api_url'        : opts.url,
+      'http_pool_size' : opts.pool or opts.jobs,
+      'http_keepalive' : not opts.no_keepalive,
+      'log_path'       : os.path.join(tmp, 'log'),
+      'log_level'      : 'warning',
+    }
+    log_configure(conf)
+
+    # Server
+    srv = None
+    if not opts.url:
+      lat = map(float, opts.latency.split(','))
+      srv = stravastub.start(latency=(lat[0], lat[-1]),
+                             error_rate=opts.error_rate,
+                             limits=(sys.maxint, sys.maxint))
+      conf['api_url'] = srv.url()
+
+    # Activity
+    segs = synth_segments(opts.size)
+    t    = track.convert(segs)
+    data = fit_activity(t['track'], t['static'])
+
+    # Run
+    strava = Strava(conf, StubAuth())
+    dt, lats, fails = run(strava, data, opts.uploads, opts.jobs)
+    n = len(lats)
+    print 'uploads    : %d (%d failed), %d bytes each' % (n, fails, len(data))
+    print 'elapsed    : %.3fs' % dt
+    print 'throughput : %.1f uploads/s, %.2f MB/s' %\
+          (n / dt, n * len(data) / dt / 1048576.0)
+    print 'latency    : p50 %.1fms p90 %.1fms p99 %.1fms max %.1fms' %\
+          tuple(percentile(lats, p) * 1000 for p in [ 50, 90, 99, 100 ])
+    if srv:
+      print 'requests   : %d' % srv.state.requests
+      srv.shutdown()
+  finally:
+    shutil.rmtree(tmp)
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
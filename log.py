@@ -23,19 +23,192 @@
 
 # System
 import os, sys, time, re
+import threading, Queue, atexit
 from datetime import datetime
 
+# ###########################################################################
+# Levels
+# ###########################################################################
+
+DEBUG   = 10
+INFO    = 20
+WARNING = 30
+ERROR   = 40
+
+LEVELS  = {
+  'debug'   : DEBUG,
+  'info'    : INFO,
+  'warning' : WARNING,
+  'error'   : ERROR,
+}
+
+NAMES   = dict((v, k.upper()) for k, v in LEVELS.items())
+
+# ###########################################################################
+# Writer
+# ###########################################################################
+
+#
+# Background log writer
+#
+# Messages are queued by log() and written out in batches, so callers never
+# block on disk. The file is rotated when it exceeds max_size bytes or is
+# older than max_age seconds.
+#
+class Logger ( threading.Thread ):
+
+  def __init__ ( self ):
+    threading.Thread.__init__(self, name='Log')
+    self.daemon     = True
+    self.path       = '/tmp/bryton-sync.log'
+    self.level      = INFO
+    self.stdout     = True
+    self.max_size   = 1048576
+    self.max_age    = 86400
+    self.backups    = 5
+    self.interval   = 1.0
+    self.batch      = 256
+    self.dropped    = 0
+    self._run       = True
+    self._queue     = Queue.Queue(65536)
+    self._lock      = threading.Lock()
+    self._fp        = None
+    self._opened    = 0
+
+  # Update configuration
+  def configure ( self, conf ):
+    self.path     = conf.get('log_path',      self.path)
+    self.level    = LEVELS.get(conf.get('log_level', 'info'), self.level)
+    self.max_size = conf.get('log_max_size',  self.max_size)
+    self.max_age  = conf.get('log_max_age',   self.max_age)
+    self.backups  = conf.get('log_backups',   self.backups)
+    self.interval = conf.get('log_flush',     self.interval)
+
+  # Queue message
+  def put ( self, m ):
+    try:
+      self._queue.put_nowait(m)
+    except Queue.Full:
+      self.dropped += 1
+
+  # Rotate log files
+  def _rotate ( self ):
+    if self._fp:
+      self._fp.close()
+      self._fp = None
+    for i in range(self.backups - 1, 0, -1):
+      p = '%s.%d' % (self.path, i)
+      if os.path.exists(p):
+        os.rename(p, '%s.%d' % (self.path, i + 1))
+    if self.backups > 0 and os.path.exists(self.path):
+      os.rename(self.path, self.path + '.1')
+
+  # Write batch of messages
+  def _write ( self, ms ):
+    if self.stdout:
+      for m in ms:
+        print m
+    try:
+      if self._fp is None:
+        self._fp     = open(self.path, 'a')
+        self._opened = time.time()
+      self._fp.write(''.join(m + '\n' for m in ms))
+      self._fp.flush()
+      if self._fp.tell() > self.max_size or\
+         time.time() - self._opened > self.max_age:
+        self._rotate()
+    except (IOError, OSError), e:
+      sys.stderr.write('log: failed to write %d messages to %s [e=%s]\n' %\
+                       (len(ms), self.path, e))
+      if self._fp:
+        try:
+          self._fp.close()
+        except (IOError, OSError):
+          pass
+      self._fp = None
+
+  # Write out queued messages (a batch if first is given, else all)
+  def flush ( self, first = None ):
+    with self._lock:
+      ms = [ first ] if first is not None else []
+      try:
+        while len(ms) < self.batch or first is None:
+          m = self._queue.get_nowait()
+          if m is not None: ms.append(m)
+      except Queue.Empty:
+        pass
+      if ms: self._write(ms)
+
+  # Flush and stop writer thread
+  def stop ( self ):
+    self._run = False
+    self._queue.put(None)
+    self.join(self.interval * 2)
+    self.flush()
+
+  # Writer thread
+  def run ( self ):
+    while self._run:
+      try:
+        m = self._queue.get(timeout=self.interval)
+      except Queue.Empty:
+        continue
+      if m is not None:
+        self.flush(m)
+
+_logger = None
+_pid    = None
+
+#
+# Get (and start) log writer
+#
+# Note: restarted after fork() (e.g. daemonise), as threads do not survive
+#
+def logger ():
+  global _logger, _pid
+  if _logger is None or _pid != os.getpid():
+    _logger = Logger()
+    _pid    = os.getpid()
+    _logger.start()
+    atexit.register(_logger.stop)
+  return _logger
+
+#
+# Configure logging
+#
+def log_configure ( conf ):
+  logger().configure(conf)
+
+# ###########################################################################
+# Log functions
+# ###########################################################################
+
 #
 # Log stuff
 #
-def log ( msg ):
+# Additional keyword arguments are appended as key=value fields
+#
+def log ( msg, level = INFO, **fields ):
+  l = logger()
+  if level < l.level: return
   now = datetime.now()
   tm  = now.strftime('%F %T')
-  m   = '%s - %s' % (tm, msg)
-  print m
-  try:
-    open('/tmp/bryton-sync.log', 'a').write(m + '\n')
-  except: pass
+  m   = '%s - %-7s - %s' % (tm, NAMES.get(level, level), msg)
+  if fields:
+    m += ' ' + ' '.join('%s=%s' % (k, fields[k]) for k in sorted(fields))
+  l.put(m)
+
+def debug ( msg, **fields ):
+  log(msg, DEBUG, **fields)
+
+def info ( msg, **fields ):
+  log(msg, INFO, **fields)
+
+def warning ( msg, **fields ):
+  log(msg, WARNING, **fields)
+
+def error ( msg, **fields ):
+  log(msg, ERROR, **fields)
 
 # ###########################################################################
 # Editor Configuration
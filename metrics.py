@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+#
+# metrics.py - Timing and throughput metrics
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, time, json
+import threading
+from contextlib import contextmanager
+
+# Local
+from log import log, WARNING
+
+# ###########################################################################
+# Metric types
+# ###########################################################################
+
+PREFIX  = 'bryton_'
+
+# Guards metric updates
+_lock   = threading.Lock()
+
+# Default histogram buckets (seconds)
+BUCKETS = [ 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0 ]
+
+#
+# Monotonic counter
+#
+class Counter:
+  kind = 'counter'
+
+  def __init__ ( self ):
+    self.value = 0
+
+  def inc ( self, n = 1 ):
+    with _lock:
+      self.value += n
+
+  def snapshot ( self ):
+    return self.value
+
+  def samples ( self, name, labels ):
+    return [ (name, labels, self.value) ]
+
+#
+# Instantaneous value
+#
+class Gauge:
+  kind = 'gauge'
+
+  def __init__ ( self ):
+    self.value = 0
+
+  def set ( self, v ):
+    self.value = v
+
+  def snapshot ( self ):
+    return self.value
+
+  def samples ( self, name, labels ):
+    return [ (name, labels, self.value) ]
+
+#
+# Histogram of observed values
+#
+class Histogram:
+  kind = 'histogram'
+
+  def __init__ ( self, buckets = BUCKETS ):
+    self.buckets = buckets
+    self.counts  = [ 0 ] * len(buckets)
+    self.count   = 0
+    self.sum     = 0.0
+
+  def observe ( self, v ):
+    with _lock:
+      self.count += 1
+      self.sum   += v
+      for i, b in enumerate(self.buckets):
+        if v <= b:
+          self.counts[i] += 1
+          break
+
+  def snapshot ( self ):
+    return {
+      'count'   : self.count,
+      'sum'     : self.sum,
+      'buckets' : dict(('%g' % b, c) for b, c in zip(self.buckets,
+                                                     self.cumulative())),
+    }
+
+  def cumulative ( self ):
+    ret = []
+    n   = 0
+    for c in self.counts:
+      n += c
+      ret.append(n)
+    return ret
+
+  def samples ( self, name, labels ):
+    ret = []
+    for b, c in zip(self.buckets, self.cumulative()):
+      ret.append((name + '_bucket', labels + [('le', '%g' % b)], c))
+    ret.append((name + '_bucket', labels + [('le', '+Inf')], self.count))
+    ret.append((name + '_sum',    labels, self.sum))
+    ret.append((name + '_count',  labels, self.count))
+    return ret
+
+# ###########################################################################
+# Registry
+# ###########################################################################
+
+#
+# Collection of named metrics, each with optional labels
+#
+class Registry:
+
+  def __init__ ( self ):
+    self._lock    = threading.Lock()
+    self._metrics = {}
+    self._help    = {}
+
+  # Get (or create) metric
+  def _get ( self, cls, name, labels, help ):
+    key = (name, tuple(sorted(labels.items())))
+    with self._lock:
+      m = self._metrics.get(key)
+      if m is None:
+        m = self._metrics[key] = cls()
+        if help: self._help[name] = help
+      return m
+
+  def counter ( self, name, help = None, **labels ):
+    return self._get(Counter, name, labels, help)
+
+  def gauge ( self, name, help = None, **labels ):
+    return self._get(Gauge, name, labels, help)
+
+  def histogram ( self, name, help = None, **labels ):
+    return self._get(Histogram, name, labels, help)
+
+  # JSON compatible snapshot
+  def snapshot ( self ):
+    ret = {}
+    with self._lock:
+      for (name, labels), m in sorted(self._metrics.items()):
+        e = { 'type' : m.kind, 'value' : m.snapshot() }
+        if labels: e['labels'] = dict(labels)
+        ret.setdefault(name, []).append(e)
+    return ret
+
+  # Prometheus text exposition format
+  def prometheus ( self ):
+    ret  = []
+    seen = set()
+    with self._lock:
+      for (name, labels), m in sorted(self._metrics.items()):
+        n = PREFIX + name
+        if name not in seen:
+          seen.add(name)
+          if name in self._help:
+            ret.append('# HELP %s %s' % (n, self._help[name]))
+          ret.append('# TYPE %s %s' % (n, m.kind))
+        for sn, sl, v in m.samples(n, list(labels)):
+          if sl:
+            sn += '{%s}' % ','.join('%s="%s"' % l for l in sl)
+          ret.append('%s %s' % (sn, repr(float(v))))
+    return '\n'.join(ret) + '\n'
+
+REGISTRY = Registry()
+
+# ###########################################################################
+# Helpers
+# ###########################################################################
+
+#
+# Increment counter
+#
+def count ( name, n = 1, **labels ):
+  REGISTRY.counter(name, **labels).inc(n)
+
+#
+# Set gauge
+#
+def gauge ( name, v, **labels ):
+  REGISTRY.gauge(name, **labels).set(v)
+
+#
+# Time a pipeline stage
+#
+@contextmanager
+def timer ( stage ):
+  t = time.time()
+  try:
+    yield
+  finally:
+    REGISTRY.histogram('stage_seconds', 'Time spent in each sync stage',
+                       stage=stage).observe(time.time() - t)
+
+_export_lock = threading.Lock()
+
+#
+# Write metrics to metrics_dir as <name>.prom and <name>.json
+#
+# Failures are logged and otherwise ignored (metrics must never stop a sync)
+#
+def export ( conf, name = 'bryton-sync' ):
+  if not conf.get('metrics_dir'): return
+  d = os.path.expanduser(conf['metrics_dir'])
+  with _export_lock:
+    try:
+      if not os.path.exists(d):
+        os.makedirs(d)
+      for ext, data in [ ('prom', REGISTRY.prometheus()),
+                         ('json', json.dumps(REGISTRY.snapshot(), indent=2)) ]:
+        p   = os.path.join(d, '%s.%s' % (name, ext))
+        tmp = p + '.tmp'
+        open(tmp, 'w').write(data)
+        os.rename(tmp, p)
+    except (IOError, OSError), e:
+      log('metrics: failed to export to %s' % d, WARNING, e=e)
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# notify.py - User notifications
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# Local
+from log import log
+
+# ###########################################################################
+# Backends
+# ###########################################################################
+
+#
+# Log only (headless)
+#
+class LogNotifier:
+
+  def notify ( self, title, msg, timeout = 2.0 ):
+    log('notify: %s - %s' % (title, msg.replace('\n', ', ')))
+
+#
+# Desktop notifications (libnotify)
+#
+class DesktopNotifier:
+
+  def __init__ ( self, name ):
+    import gi
+    gi.require_version('Notify', '0.7')
+    from gi.repository import Notify
+    self._notify = Notify
+    Notify.init(name)
+
+  def notify ( self, title, msg, timeout = 2.0 ):
+    n = self._notify.Notification.new(title, msg)
+    #n.set_data(title, msg)
+    n.set_timeout(timeout * 1000)
+    n.show()
+
+#
+# Create appropriate notifier
+#
+def notifier ( conf, name = 'bryton-sync' ):
+  if conf['headless']:
+    return LogNotifier()
+  return DesktopNotifier(name)
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+#
+# poller.py - Asynchronous Strava upload status polling
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, time
+import threading, heapq
+
+# Local
+import metrics
+from log import log, WARNING
+
+# ###########################################################################
+# Upload states
+# ###########################################################################
+
+READY     = 'ready'
+DUPLICATE = 'duplicate'
+ERROR     = 'error'
+TIMEOUT   = 'timeout'
+
+#
+# Classify upload status response (None if still processing)
+#
+def state ( status ):
+  if status.get('error'):
+    if 'duplicate' in status['error']: return DUPLICATE
+    return ERROR
+  if status.get('activity_id'):
+    return READY
+  return None
+
+# ###########################################################################
+# Poller
+# ###########################################################################
+
+#
+# Tracks in-flight uploads in a timer heap and checks their status in the
+# background, calling done(ctx, state, status) once each has finished
+# processing
+#
+# Polls start at roughly the recent average processing time and back off
+# (by 1.5x, up to poll_max) while an upload is still being processed. All
+# uploads due at the same time are checked in one pass.
+#
+class UploadPoller ( threading.Thread ):
+
+  def __init__ ( self, strava, done, conf ):
+    threading.Thread.__init__(self, name='UploadPoller')
+    self.daemon  = True
+    self._strava = strava
+    self._done   = done
+    self._min    = conf.get('poll_min', 2.0)
+    self._max    = conf.get('poll_max', 60.0)
+    self._limit  = conf.get('poll_timeout', 3600.0)
+    self._cv     = threading.Condition()
+    self._heap   = [] # (due, upload id)
+    self._jobs   = {} # upload id -> [ ctx, submitted, interval ]
+    self._avg    = None
+    self._run    = True
+
+  # Number of uploads in flight
+  def __len__ ( self ):
+    with self._cv:
+      return len(self._jobs)
+
+  #
+  # Track new upload
+  #
+  def add ( self, upload_id, ctx ):
+    now = time.time()
+    ivl = max(self._min, (self._avg or self._min) * 0.8)
+    with self._cv:
+      self._jobs[upload_id] = [ ctx, now, self._min ]
+      heapq.heappush(self._heap, (now + ivl, upload_id))
+      metrics.gauge('uploads_in_flight', len(self._jobs))
+      self._cv.notify()
+
+  def stop ( self ):
+    with self._cv:
+      self._run = False
+      self._cv.notify()
+
+  # Wait for and remove all due uploads
+  def _due ( self ):
+    with self._cv:
+      while self._run:
+        now = time.time()
+        if self._heap and self._heap[0][0] <= now: break
+        self._cv.wait(self._heap[0][0] - now if self._heap else None)
+      ret = []
+      while self._heap and self._heap[0][0] <= time.time():
+        ret.append(heapq.heappop(self._heap)[1])
+      return ret
+
+  # Finished (or given up)
+  def _finish ( self, upload_id, st, status ):
+    with self._cv:
+      ctx, t0, ivl = self._jobs.pop(upload_id)
+      metrics.gauge('uploads_in_flight', len(self._jobs))
+    dt = time.time() - t0
+    if st in (READY, DUPLICATE):
+      self._avg = dt if self._avg is None else 0.8 * self._avg + 0.2 * dt
+    metrics.count('uploads_finished', state=st)
+    log('upload %s: %s after %.0fs' % (upload_id, st, dt))
+    try:
+      self._done(ctx, st, status)
+    except Exception, e:
+      log('upload %s: completion failed [e=%s]' % (upload_id, e), WARNING)
+
+  # Check a single upload
+  def _check ( self, upload_id ):
+    job    = self._jobs[upload_id]
+    status = {}
+    try:
+      status = self._strava.upload_status(upload_id)
+      st     = state(status)
+    except Exception, e:
+      log('upload %s: status check failed [e=%s]' % (upload_id, e), WARNING)
+      st     = None
+
+    # Still processing
+    if st is None:
+      if time.time() - job[1] > self._limit:
+        return self._finish(upload_id, TIMEOUT, status)
+      with self._cv:
+        job[2] = min(self._max, job[2] * 1.5)
+        heapq.heappush(self._heap, (time.time() + job[2], upload_id))
+      return
+
+    self._finish(upload_id, st, status)
+
+  def run ( self ):
+    while self._run:
+      for i in self._due():
+        if not self._run: break
+        self._check(i)
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# profiling.py - Per-stage CPU and memory profiling
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, time
+import threading
+import cProfile
+
+# Optional (python 3.4+ or pytracemalloc)
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+# Local
+from log import log, WARNING
+
+# ###########################################################################
+# Capture
+# ###########################################################################
+
+#
+# Disabled stage (shared, so profiling costs nothing when off)
+#
+class NullStage:
+  def __enter__ ( self ):
+    return self
+  def __exit__ ( self, *args ):
+    return False
+
+NULL = NullStage()
+
+#
+# Profiled stage
+#
+class Stage:
+
+  def __init__ ( self, capture, name ):
+    self._capture = capture
+    self._name    = name
+
+  def __enter__ ( self ):
+    c = self._capture
+    if tracemalloc:
+      self._mem = tracemalloc.get_traced_memory()[0]
+      if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    self._t = time.time()
+    c.prof.enable()
+    return self
+
+  def __exit__ ( self, *args ):
+    c = self._capture
+    c.prof.disable()
+    dt  = time.time() - self._t
+    mem = None
+    if tracemalloc:
+      cur, peak = tracemalloc.get_traced_memory()
+      mem = (cur - self._mem, peak - self._mem)
+    c.stages.append((self._name, dt, mem))
+    return False
+
+#
+# Capture for a single track
+#
+class Capture:
+
+  def __init__ ( self, name ):
+    self.name   = name
+    self.prof   = cProfile.Profile()
+    self.stages = []
+
+# ###########################################################################
+# Profiler
+# ###########################################################################
+
+_conf  = { 'dir' : None, 'top' : 25 }
+_local = threading.local()
+
+#
+# Enable profiling, output is written to outdir
+#
+def configure ( outdir, top = 25 ):
+  _conf['dir'] = os.path.expanduser(outdir) if outdir else None
+  _conf['top'] = top
+  if not _conf['dir']: return
+  if not os.path.exists(_conf['dir']):
+    os.makedirs(_conf['dir'])
+  if tracemalloc and not tracemalloc.is_tracing():
+    tracemalloc.start()
+  log('profiling enabled, output to %s' % _conf['dir'])
+
+#
+# Check if enabled
+#
+def enabled ():
+  return _conf['dir'] is not None
+
+#
+# Begin capture for named track (in this thread)
+#
+def begin ( name ):
+  if _conf['dir'] is None: return
+  _local.capture = Capture(name)
+
+#
+# Profile a pipeline stage (no-op unless a capture is active)
+#
+def stage ( name ):
+  c = getattr(_local, 'capture', None)
+  if c is None: return NULL
+  return Stage(c, name)
+
+#
+# Finish capture, writing <name>.pstats and <name>.alloc.txt (if any stages
+# were run)
+#
+# Write failures are logged and otherwise ignored (end() is called from
+# finally blocks in the sync and device threads)
+#
+def end ():
+  c = getattr(_local, 'capture', None)
+  _local.capture = None
+  if c is None or not c.stages: return
+  base = os.path.join(_conf['dir'], c.name)
+  try:
+    _write(c, base)
+  except (IOError, OSError), e:
+    log('failed to write profile %s' % base, WARNING, e=e)
+
+#
+# Write capture output
+#
+def _write ( c, base ):
+
+  # CPU
+  c.prof.dump_stats(base + '.pstats')
+
+  # Stage summary and allocations
+  out = [ '%-20s %10s %12s %12s' % ('stage', 'secs', 'alloc kB', 'peak kB') ]
+  for n, dt, mem in c.stages:
+    if mem:
+      out.append('%-20s %10.3f %12.1f %12.1f' %\
+                 (n, dt, mem[0] / 1024.0, mem[1] / 1024.0))
+    else:
+      out.append('%-20s %10.3f %12s %12s' % (n, dt, '-', '-'))
+  if tracemalloc:
+    out.append('')
+    out.append('Top allocations:')
+    snap = tracemalloc.take_snapshot()
+    for s in snap.statistics('lineno')[:_conf['top']]:
+      out.append('  %s' % s)
+  else:
+    out.append('')
+    out.append('tracemalloc not available, no allocation data')
+  open(base + '.alloc.txt', 'w').write('\n'.join(out) + '\n')
+  log('profile written to %s.{pstats,alloc.txt}' % base)
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
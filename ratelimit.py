@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#
+# ratelimit.py - Strava API rate limit scheduling
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, time
+import threading, heapq
+
+# Local
+import metrics
+from log import log, DEBUG, WARNING
+
+# ###########################################################################
+# Priorities
+# ###########################################################################
+
+UPLOAD = 0 # New uploads
+LOOKUP = 1 # Duplicate checks (get_activities)
+STATUS = 2 # Upload status polls
+
+NAMES  = { UPLOAD : 'upload', LOOKUP : 'lookup', STATUS : 'status' }
+
+#
+# Fraction of each window held back from lower priority requests, so that
+# lookups and polls can never use up the budget needed for uploads
+#
+RESERVE = { UPLOAD : 0.0, LOOKUP : 0.05, STATUS : 0.2 }
+
+# ###########################################################################
+# Token bucket
+# ###########################################################################
+
+#
+# Request budget for one fixed window (Strava windows are aligned to the
+# quarter hour and to midnight UTC)
+#
+class Bucket:
+
+  def __init__ ( self, limit, window ):
+    self.limit  = limit
+    self.window = window
+    self.used   = 0
+    self.reset  = self._next()
+
+  # Start of next window
+  def _next ( self ):
+    return (int(time.time()) // self.window + 1) * self.window
+
+  # Roll over to new window (returns True if it did)
+  def _check ( self ):
+    if time.time() >= self.reset:
+      self.used  = 0
+      self.reset = self._next()
+      return True
+    return False
+
+  # Tokens left for a given priority
+  def available ( self, prio ):
+    self._check()
+    return self.limit * (1.0 - RESERVE[prio]) - self.used
+
+  # Minimum spacing between requests, once over half the budget is used the
+  # remainder is spread evenly over the rest of the window
+  def interval ( self ):
+    self._check()
+    left = self.limit - self.used
+    if self.used < self.limit / 2 or left <= 0: return 0.0
+    return (self.reset - time.time()) / left
+
+# ###########################################################################
+# Scheduler
+# ###########################################################################
+
+#
+# Grant API requests in priority order without exceeding the 15 minute or
+# daily limits
+#
+# Usage is tracked locally for each request granted and corrected from the
+# X-RateLimit-Usage/Limit headers on every response (plus any requests
+# still in flight). Every acquire() must be paired with a release() once
+# the request has completed (or failed).
+#
+class Scheduler:
+
+  def __init__ ( self, limits = (600, 30000) ):
+    self._cv      = threading.Condition()
+    self._buckets = [ Bucket(limits[0], 900), Bucket(limits[1], 86400) ]
+    self._waiting = []
+    self._seq     = 0
+    self._last    = 0.0
+    self._flight  = 0
+
+  # Roll over windows, requests in flight before the 15 minute window
+  # reset are no longer counted against it
+  def _check ( self ):
+    if self._buckets[0]._check():
+      self._flight = 0
+    self._buckets[1]._check()
+
+  # Time to wait before request at prio can be granted (0 if now)
+  def _delay ( self, prio ):
+    self._check()
+    now = time.time()
+    ret = 0.0
+    for b in self._buckets:
+      if b.available(prio) < 1:
+        ret = max(ret, b.reset - now)
+      else:
+        ret = max(ret, self._last + b.interval() - now)
+    return ret
+
+  #
+  # Wait for permission to make a request
+  #
+  def acquire ( self, prio = UPLOAD ):
+    with self._cv:
+      self._seq += 1
+      me = (prio, self._seq)
+      heapq.heappush(self._waiting, me)
+      t0 = time.time()
+      try:
+        while True:
+          if self._waiting[0] == me:
+            d = self._delay(prio)
+            if d <= 0: break
+            log('ratelimit: delaying %s for %.1fs' % (NAMES[prio], d), DEBUG)
+          else:
+            d = 1.0
+          self._cv.wait(min(d, 60.0))
+        for b in self._buckets:
+          b.used += 1
+        self._last    = time.time()
+        self._flight += 1
+      finally:
+        self._waiting.remove(me)
+        heapq.heapify(self._waiting)
+        self._cv.notify_all()
+    metrics.count('ratelimit_requests', priority=NAMES[prio])
+    metrics.gauge('ratelimit_wait_seconds', time.time() - t0,
+                  priority=NAMES[prio])
+
+  #
+  # Request granted by acquire() has completed
+  #
+  def release ( self ):
+    with self._cv:
+      self._flight = max(0, self._flight - 1)
+      self._cv.notify_all()
+
+  # Parse limit/usage headers (None if not present)
+  def _parse ( self, headers ):
+    try:
+      lim = map(int, headers['X-RateLimit-Limit'].split(','))
+      use = map(int, headers['X-RateLimit-Usage'].split(','))
+    except (KeyError, ValueError, AttributeError):
+      return None
+    return zip(self._buckets, lim, use)
+
+  #
+  # Update from response headers
+  #
+  # The response being handled is counted by the server but has not been
+  # released yet, so it is not added to the usage again
+  #
+  def update ( self, headers ):
+    hdr = self._parse(headers)
+    if hdr is None: return
+    with self._cv:
+      self._check()
+      for b, l, u in hdr:
+        b.limit = l
+        b.used  = u + max(0, self._flight - 1)
+      self._cv.notify_all()
+    for n, b in zip([ '15min', 'daily' ], self._buckets):
+      metrics.gauge('ratelimit_usage', b.used, window=n)
+
+  #
+  # Limit exceeded (429), no more requests until the window that is over
+  # its limit resets (from the response headers if present, otherwise
+  # local usage, otherwise assume the 15 minute window)
+  #
+  def throttled ( self, headers = {} ):
+    log('ratelimit: limit exceeded', WARNING)
+    metrics.count('ratelimit_exceeded')
+    hdr = self._parse(headers)
+    with self._cv:
+      self._check()
+      if hdr is not None:
+        over = [ b for b, l, u in hdr if u >= l ]
+      else:
+        over = [ b for b in self._buckets if b.used >= b.limit ]
+      for b in over or self._buckets[:1]:
+        b.used = b.limit
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+#
+# replay.py - Raw device image capture and replay
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, time, struct, mmap
+import threading
+
+# ###########################################################################
+# Format
+# ###########################################################################
+
+#
+# Image layout (all little endian):
+#
+#   header  - magic, version, entry count
+#   index   - per entry: key length, data offset, data length, key
+#   data    - raw bytes returned by the device, one blob per entry
+#
+# A key identifies a DeviceAccess call (method name and arguments), so an
+# image replays exactly the reads made while it was captured. Repeated
+# reads of the same blocks are stored once.
+#
+
+MAGIC   = 'BRIM'
+VERSION = 1
+HEADER  = struct.Struct('<4sBI')
+ENTRY   = struct.Struct('<HQI')
+
+EXT     = '.img'
+
+#
+# Key for a call
+#
+def _key ( name, args, kwargs ):
+  return '%s%r%r' % (name, args, sorted(kwargs.items()))
+
+# ###########################################################################
+# Capture
+# ###########################################################################
+
+#
+# DeviceAccess wrapper that records every raw read
+#
+# Any method returning a string is recorded, everything else (open, close,
+# etc) is passed straight through
+#
+class Recorder:
+
+  def __init__ ( self, deva ):
+    self._deva  = deva
+    self._lock  = threading.Lock()
+    self._keys  = []
+    self._data  = {}
+
+  def __getattr__ ( self, name ):
+    fn = getattr(self._deva, name)
+    if not callable(fn): return fn
+    def call ( *args, **kwargs ):
+      ret = fn(*args, **kwargs)
+      if isinstance(ret, str):
+        k = _key(name, args, kwargs)
+        with self._lock:
+          if k not in self._data:
+            self._keys.append(k)
+            self._data[k] = ret
+      return ret
+    return call
+
+  # Number of recorded reads
+  def __len__ ( self ):
+    return len(self._keys)
+
+  # Write image
+  def save ( self, path ):
+    with self._lock:
+      keys = list(self._keys)
+    off = HEADER.size + sum(ENTRY.size + len(k) for k in keys)
+    tmp = path + '.tmp'
+    fp  = open(tmp, 'wb')
+    try:
+      fp.write(HEADER.pack(MAGIC, VERSION, len(keys)))
+      for k in keys:
+        fp.write(ENTRY.pack(len(k), off, len(self._data[k])))
+        fp.write(k)
+        off += len(self._data[k])
+      for k in keys:
+        fp.write(self._data[k])
+    finally:
+      fp.close()
+    os.rename(tmp, path)
+
+# ###########################################################################
+# Replay
+# ###########################################################################
+
+#
+# DeviceAccess stand-in serving reads from a captured image
+#
+# The image is mmap'd, so only the blocks actually read are paged in.
+# latency (seconds) is added to every read to simulate USB transfers.
+#
+class ReplayAccess:
+
+  def __init__ ( self, path, latency = 0.0 ):
+    self.path     = path
+    self.latency  = latency
+    self.reads    = 0
+    self._fp      = None
+    self._mm      = None
+    self._index   = {}
+
+  def open ( self ):
+    self._fp = open(self.path, 'rb')
+    self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, ver, n = HEADER.unpack_from(self._mm)
+    if magic != MAGIC:
+      raise IOError('%s: not a device image' % self.path)
+    if ver != VERSION:
+      raise IOError('%s: unsupported image version %d' % (self.path, ver))
+    off = HEADER.size
+    for i in range(n):
+      kl, doff, dlen = ENTRY.unpack_from(self._mm, off)
+      off += ENTRY.size
+      self._index[self._mm[off:off+kl]] = (doff, dlen)
+      off += kl
+
+  def close ( self ):
+    if self._mm: self._mm.close()
+    if self._fp: self._fp.close()
+    self._mm = self._fp = None
+
+  def __getattr__ ( self, name ):
+    if name.startswith('_'): raise AttributeError(name)
+    def call ( *args, **kwargs ):
+      k = _key(name, args, kwargs)
+      if k not in self._index:
+        raise IOError('%s: %s not in image' % (self.path, k))
+      if self.latency: time.sleep(self.latency)
+      self.reads += 1
+      off, n = self._index[k]
+      return self._mm[off:off+n]
+    return call
+
+#
+# Check whether path is a device image
+#
+def is_image ( path ):
+  return path.endswith(EXT) and os.path.isfile(path)
+
+# ###########################################################################
+# Main
+# ###########################################################################
+
+if __name__ == '__main__':
+  from optparse import OptionParser
+
+  # Local
+  sys.path.insert(0, 'bryton-gps-linux/code')
+  from brytongps import get_device
+
+  # Command line
+  optp = OptionParser(usage='%prog [options] image ...')
+  optp.add_option('-l', '--latency', default=0.0, type='float',
+                  help='Simulated per read latency (seconds)')
+  optp.add_option('-i', '--info', default=False, action='store_true',
+                  help='Show image information only')
+  (opts, args) = optp.parse_args()
+
+  # Replay device reads
+  for a in args:
+    deva = ReplayAccess(a, opts.latency)
+    deva.open()
+    try:
+      if opts.info:
+        print '%s: %d reads, %d bytes' %\
+              (a, len(deva._index), sum(n for o, n in deva._index.values()))
+        continue
+      t0      = time.time()
+      mod,dev = get_device(deva)
+      hist    = mod.read_history(dev)
+      pts     = 0
+      for h in hist:
+        pts += sum(len(s) for s in h.merged_segments())
+      dt      = max(time.time() - t0, 1e-6)
+      print '%s: %d rides, %d points, %d reads in %.3fs (%.0f points/s)' %\
+            (a, len(hist), pts, deva.reads, dt, pts / dt)
+    finally:
+      deva.close()
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
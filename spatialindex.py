@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+#
+# spatialindex.py - Grid cell index of the track cache
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, time, math
+import threading
+
+# Local
+import trackfile
+from log import log
+
+# ###########################################################################
+# Cells
+# ###########################################################################
+
+CELL = 0.01 # degrees (~1km of latitude)
+
+#
+# Cell containing position
+#
+def cell ( lat, lon, size = CELL ):
+  return (int(math.floor(lat / size)), int(math.floor(lon / size)))
+
+#
+# Postings for a track: [ (cell, first point, last point) ], one for each
+# run of consecutive points in the same cell (static rides have none)
+#
+def postings ( t, size = CELL ):
+  ret = []
+  if t['static']: return ret
+  cur = None
+  for i, p in enumerate(t['track']):
+    if 'latitude' not in p: continue
+    c = cell(p['latitude'], p['longitude'], size)
+    if c != cur:
+      ret.append([ c, i, i ])
+      cur = c
+    else:
+      ret[-1][2] = i
+  return [ tuple(r) for r in ret ]
+
+#
+# Cells within radius (in cells) of c
+#
+def around ( c, radius = 1 ):
+  return [ (c[0] + i, c[1] + j) for i in range(-radius, radius + 1)
+                                for j in range(-radius, radius + 1) ]
+
+# ###########################################################################
+# Index
+# ###########################################################################
+
+#
+# Grid cell -> (track, point range) index of cached tracks
+#
+# Stored as an append-only file with one line per track:
+#
+#   name lat:lon:first:last ...
+#
+# preceded by a "cell <size>" line. A file for a different cell size is
+# ignored (and rebuilt).
+#
+class SpatialIndex:
+
+  def __init__ ( self, path, size = CELL ):
+    self._path   = os.path.expanduser(path)
+    self._size   = size
+    self._lock   = threading.Lock()
+    self._cells  = {} # cell -> [ (name, first, last) ]
+    self._tracks = {} # name -> set(cells)
+    self._valid  = False
+    try:
+      fp = open(self._path)
+      try:
+        hdr = fp.readline().split()
+        if hdr != [ 'cell', repr(size) ]:
+          log('spatialindex: cell size changed, ignoring %s' % self._path)
+          return
+        self._valid = True
+        for l in fp:
+          p = l.split()
+          if not p: continue
+          self._insert(p[0], [ self._parse(x) for x in p[1:] ])
+      finally:
+        fp.close()
+    except IOError:
+      pass
+
+  # Check if index file exists (and is usable)
+  def exists ( self ):
+    return self._valid
+
+  def __len__ ( self ):
+    return len(self._tracks)
+
+  def __contains__ ( self, name ):
+    return name in self._tracks
+
+  # Parse/format posting
+  def _parse ( self, s ):
+    a, b, f, l = map(int, s.split(':'))
+    return ((a, b), f, l)
+
+  def _format ( self, name, posts ):
+    return ' '.join([ name ] + [ '%d:%d:%d:%d' % (c[0], c[1], f, l)
+                                 for c, f, l in posts ]) + '\n'
+
+  # Insert postings (replacing any previous entry for name)
+  def _insert ( self, name, posts ):
+    if name in self._tracks:
+      self._remove(name)
+    cells = set()
+    for c, f, l in posts:
+      self._cells.setdefault(c, []).append((name, f, l))
+      cells.add(c)
+    self._tracks[name] = cells
+
+  # Remove entry
+  def _remove ( self, name ):
+    for c in self._tracks.pop(name):
+      ps = [ p for p in self._cells[c] if p[0] != name ]
+      if ps:
+        self._cells[c] = ps
+      else:
+        del self._cells[c]
+
+  # Rewrite index file from memory (lock held)
+  def _save ( self ):
+    posts = dict((n, []) for n in self._tracks)
+    for c, ps in self._cells.iteritems():
+      for n, f, l in ps:
+        posts[n].append((c, f, l))
+    d = os.path.dirname(self._path)
+    if d and not os.path.exists(d):
+      os.makedirs(d)
+    tmp = self._path + '.tmp'
+    open(tmp, 'w').write('cell %r\n' % self._size +
+                         ''.join(self._format(n, sorted(ps, key=lambda p: p[1]))
+                                 for n, ps in sorted(posts.items())))
+    os.rename(tmp, self._path)
+    self._valid = True
+
+  #
+  # Add track
+  #
+  def add ( self, name, t ):
+    posts = postings(t, self._size)
+    with self._lock:
+      self._insert(name, posts)
+      d = os.path.dirname(self._path)
+      if d and not os.path.exists(d):
+        os.makedirs(d)
+      if not self._valid:
+        open(self._path, 'w').write('cell %r\n' % self._size)
+        self._valid = True
+      fp = open(self._path, 'a')
+      try:
+        fp.write(self._format(name, posts))
+      finally:
+        fp.close()
+
+  #
+  # Rebuild from track directory (loads every track), running() is checked
+  # before each track and the rebuild abandoned if it returns False
+  #
+  def rebuild ( self, tdir, running = lambda: True ):
+    ents = []
+    for f in sorted(os.listdir(tdir)):
+      if not f.endswith('.track'): continue
+      if not running(): return
+      try:
+        ents.append((f, postings(trackfile.load(os.path.join(tdir, f)),
+                                 self._size)))
+      except Exception, e:
+        log('spatialindex: skipping %s [e=%s]' % (f, e))
+    with self._lock:
+      self._cells  = {}
+      self._tracks = {}
+      for n, ps in ents:
+        self._insert(n, ps)
+      self._save()
+    log('spatialindex: indexed %d tracks' % len(ents))
+
+  #
+  # Reconcile with track directory, indexing tracks missing from the index
+  # (e.g. copied in while not running) and dropping removed tracks
+  #
+  # running() is checked before each track is loaded, tracks indexed
+  # before stopping are kept
+  #
+  def reconcile ( self, tdir, running = lambda: True ):
+    names = set(f for f in os.listdir(tdir) if f.endswith('.track'))
+    with self._lock:
+      missing = sorted(names - set(self._tracks))
+      stale   = set(self._tracks) - names
+    if stale:
+      with self._lock:
+        for n in stale:
+          if n in self._tracks: self._remove(n)
+        self._save()
+    added = 0
+    for n in missing:
+      if not running(): break
+      try:
+        self.add(n, trackfile.load(os.path.join(tdir, n)))
+        added += 1
+      except Exception, e:
+        log('spatialindex: skipping %s [e=%s]' % (n, e))
+    if missing or stale:
+      log('spatialindex: added %d of %d, removed %d tracks' %\
+          (added, len(missing), len(stale)))
+
+  #
+  # Tracks passing through the cells covering a bounding box
+  #
+  # Returns { name : [ (first, last) ] }
+  #
+  def bbox ( self, lat0, lon0, lat1, lon1 ):
+    c0  = cell(min(lat0, lat1), min(lon0, lon1), self._size)
+    c1  = cell(max(lat0, lat1), max(lon0, lon1), self._size)
+    ret = {}
+    with self._lock:
+      for i in range(c0[0], c1[0] + 1):
+        for j in range(c0[1], c1[1] + 1):
+          for n, f, l in self._cells.get((i, j), []):
+            ret.setdefault(n, []).append((f, l))
+    for r in ret.values():
+      r.sort()
+    return ret
+
+  #
+  # Tracks following a route (list of (lat, lon))
+  #
+  # A route cell is matched by a track passing within radius cells of it.
+  # Score is the smaller of the fraction of the route covered by the track
+  # and of the track covered by the route, so 1.0 is the same route and a
+  # short ride along part of a long one scores low either way (use
+  # min_cover to match segments of longer rides instead).
+  #
+  # Returns [ (score, cover, name, (first, last)) ] best first, where cover
+  # is the fraction of the route matched and first/last the range of
+  # track points spanning the matched cells
+  #
+  def route ( self, pts, radius = 1, min_score = 0.0, min_cover = 0.0,
+              exclude = None ):
+    route = set(cell(lat, lon, self._size) for lat, lon in pts)
+    if not route: return []
+    near  = set()
+    for c in route:
+      near.update(around(c, radius))
+
+    with self._lock:
+
+      # Route cells matched and point range, per track
+      hits  = {}
+      span  = {}
+      for c in route:
+        seen = set()
+        for a in around(c, radius):
+          for n, f, l in self._cells.get(a, []):
+            seen.add(n)
+            s = span.get(n)
+            span[n] = (min(s[0], f), max(s[1], l)) if s else (f, l)
+        for n in seen:
+          hits[n] = hits.get(n, 0) + 1
+
+      # Score candidates
+      ret = []
+      for n, h in hits.iteritems():
+        if n == exclude: continue
+        cover = float(h) / len(route)
+        cells = self._tracks[n]
+        back  = float(len(cells & near)) / len(cells)
+        score = min(cover, back)
+        if score >= min_score and cover >= min_cover:
+          ret.append((score, cover, n, span[n]))
+    ret.sort(reverse=True)
+    return ret
+
+  #
+  # Tracks similar to an indexed track
+  #
+  def similar ( self, name, radius = 1, min_score = 0.5 ):
+    with self._lock:
+      cells = self._tracks.get(name, set())
+    s = self._size
+    return self.route([ ((a + 0.5) * s, (b + 0.5) * s) for a, b in cells ],
+                      radius, min_score, exclude=name)
+
+# ###########################################################################
+# Main
+# ###########################################################################
+
+if __name__ == '__main__':
+  from optparse import OptionParser
+
+  # Command line
+  optp = OptionParser(usage='%prog [options]')
+  optp.add_option('-i', '--index', default='~/.bryton/cells.idx',
+                  help='Index file')
+  optp.add_option('--rebuild', default=None, metavar='DIR',
+                  help='Rebuild index from track cache in DIR')
+  optp.add_option('-b', '--bbox', default=None,
+                  metavar='LAT0,LON0,LAT1,LON1',
+                  help='Rides passing through bounding box')
+  optp.add_option('-r', '--route', default=None, metavar='TRACK',
+                  help='Rides following the route of a track file')
+  optp.add_option('-s', '--similar', default=None, metavar='NAME',
+                  help='Rides similar to an indexed track')
+  optp.add_option('--min-score', default=0.5, type='float',
+                  help='Minimum route similarity (0-1)')
+  optp.add_option('--min-cover', default=0.0, type='float',
+                  help='Minimum fraction of route ridden (0-1)')
+  optp.add_option('-n', '--limit', default=None, type='int',
+                  help='Show at most N rides')
+  (opts, args) = optp.parse_args()
+
+  idx = SpatialIndex(opts.index)
+  if opts.rebuild:
+    idx.rebuild(os.path.expanduser(opts.rebuild))
+
+  # Queries
+  t0  = time.time()
+  res = None
+  if opts.bbox:
+    b   = map(float, opts.bbox.split(','))
+    res = [ (n, r) for n, r in sorted(idx.bbox(*b).items()) ]
+    dt  = time.time() - t0
+    for n, r in res[:opts.limit]:
+      print '%s %s' % (n, ' '.join('%d-%d' % x for x in r))
+  elif opts.route or opts.similar:
+    if opts.route:
+      t   = trackfile.load(os.path.expanduser(opts.route))
+      pts = [ (p['latitude'], p['longitude']) for p in t['track']
+              if 'latitude' in p ]
+      res = idx.route(pts, min_score=opts.min_score,
+                      min_cover=opts.min_cover,
+                      exclude=os.path.basename(opts.route))
+    else:
+      res = idx.similar(opts.similar, min_score=opts.min_score)
+    dt  = time.time() - t0
+    for s, c, n, r in res[:opts.limit]:
+      print '%s score %.2f cover %.2f points %d-%d' % (n, s, c, r[0], r[1])
+  if res is not None:
+    print '%d of %d tracks (%.2fms)' % (len(res), len(idx), dt * 1000)
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
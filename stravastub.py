@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+#
+# stravastub.py - Local Strava API stand-in (for load testing)
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, time, json, re, random, cgi
+import threading, datetime, urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer   import ThreadingMixIn
+
+# ###########################################################################
+# State
+# ###########################################################################
+
+#
+# Stub behaviour
+#
+#   latency      - (min, max) seconds added to every request
+#   error_rate   - fraction of requests failing with a 500
+#   process_time - seconds before an upload is processed
+#   dup_rate     - fraction of uploads rejected as duplicates (on processing)
+#   limits       - (15 minute, daily) request limits, 429 once exceeded
+#
+DEFAULTS = {
+  'latency'      : (0.0, 0.0),
+  'error_rate'   : 0.0,
+  'process_time' : 0.0,
+  'dup_rate'     : 0.0,
+  'limits'       : (600, 30000),
+}
+
+#
+# Fake account (uploads and activities)
+#
+class State:
+
+  def __init__ ( self, **opts ):
+    self.opts       = dict(DEFAULTS)
+    self.opts.update(opts)
+    self.lock       = threading.Lock()
+    self.rnd        = random.Random(1)
+    self.uploads    = {}
+    self.activities = []
+    self.usage      = [ 0, 0 ]
+    self.window     = [ time.time(), time.time() ]
+    self.requests   = 0
+
+  # Count request against the rate limits (returns usage, limited)
+  def rate ( self ):
+    now = time.time()
+    with self.lock:
+      self.requests += 1
+      if now - self.window[0] >= 900:
+        self.window[0] = now
+        self.usage[0]  = 0
+      if now - self.window[1] >= 86400:
+        self.window[1] = now
+        self.usage[1]  = 0
+      self.usage[0] += 1
+      self.usage[1] += 1
+      over = self.usage[0] > self.opts['limits'][0] or\
+             self.usage[1] > self.opts['limits'][1]
+      return list(self.usage), over
+
+  # Random failure
+  def fail ( self, rate ):
+    with self.lock:
+      return self.rnd.random() < rate
+
+  # New upload
+  def upload ( self, name, size, ext ):
+    with self.lock:
+      i = len(self.uploads) + 1
+      self.uploads[i] = {
+        'id'          : i,
+        'external_id' : name,
+        'size'        : size,
+        'type'        : ext,
+        'created'     : time.time(),
+        'dup'         : self.rnd.random() < self.opts['dup_rate'],
+        'activity_id' : None,
+      }
+      return self.status(i)
+
+  # Upload status (processing completes process_time after upload)
+  def status ( self, i ):
+    u = self.uploads.get(i)
+    if u is None: return None
+    ret = {
+      'id'          : u['id'],
+      'external_id' : u['external_id'],
+      'error'       : None,
+      'status'      : 'Your activity is still being processed.',
+      'activity_id' : None,
+    }
+    if time.time() - u['created'] < self.opts['process_time']:
+      return ret
+    if u['dup']:
+      ret['error']  = '%s duplicate of activity 1' % u['external_id']
+      ret['status'] = 'There was an error processing your activity.'
+      return ret
+    if u['activity_id'] is None:
+      u['activity_id'] = len(self.activities) + 1
+      start = datetime.datetime.utcfromtimestamp(u['created'])
+      self.activities.append({
+        'id'           : u['activity_id'],
+        'name'         : u['external_id'],
+        'start_date'   : start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'elapsed_time' : 3600,
+        'moving_time'  : 3600,
+        'distance'     : 0.0,
+        'type'         : 'Ride',
+      })
+    ret['status']      = 'Your activity is ready.'
+    ret['activity_id'] = u['activity_id']
+    return ret
+
+# ###########################################################################
+# Server
+# ###########################################################################
+
+class Handler ( BaseHTTPRequestHandler ):
+
+  protocol_version = 'HTTP/1.1'
+
+  def log_message ( self, *args ):
+    pass
+
+  # Send JSON response (with rate limit headers)
+  def reply ( self, code, obj, usage ):
+    data = json.dumps(obj)
+    lim  = self.server.state.opts['limits']
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.send_header('X-RateLimit-Limit', '%d,%d' % lim)
+    self.send_header('X-RateLimit-Usage', '%d,%d' % tuple(usage))
+    self.end_headers()
+    self.wfile.write(data)
+
+  # Common request handling
+  def handle_api ( self, method ):
+    st    = self.server.state
+    url   = urlparse.urlparse(self.path)
+    query = dict(urlparse.parse_qsl(url.query))
+    form  = None
+
+    # Read body
+    if method == 'POST':
+      form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                              environ={ 'REQUEST_METHOD' : 'POST',
+                                        'CONTENT_TYPE'   :
+                                          self.headers.get('Content-Type',
+                                                           '') })
+
+    # Simulated network/server time
+    lo, hi = st.opts['latency']
+    if hi: time.sleep(st.rnd.uniform(lo, hi))
+
+    # Rate limit
+    usage, over = st.rate()
+    if over:
+      return self.reply(429, { 'message' : 'Rate Limit Exceeded' }, usage)
+
+    # Auth (header or access_token parameter)
+    token = self.headers.get('Authorization') or query.get('access_token')
+    if not token and form is not None and 'access_token' in form:
+      token = form.getvalue('access_token')
+    if not token:
+      return self.reply(401, { 'message' : 'Authorization Error' }, usage)
+
+    # Server error
+    if st.fail(st.opts['error_rate']):
+      return self.reply(500, { 'message' : 'Internal Error' }, usage)
+
+    # Routes
+    path = url.path
+    if method == 'GET' and path == '/api/v3/athlete':
+      return self.reply(200, { 'id' : 1, 'firstname' : 'Stub',
+                               'lastname' : 'Rider' }, usage)
+    if method == 'GET' and path == '/api/v3/athlete/activities':
+      after  = float(query.get('after', 0))
+      before = float(query.get('before', sys.maxint))
+      page   = int(query.get('page', 1))
+      per    = int(query.get('per_page', 30))
+      with st.lock:
+        aa = [ a for a in st.activities
+               if after <= _epoch(a['start_date']) <= before ]
+      return self.reply(200, aa[(page-1)*per:page*per], usage)
+    if method == 'POST' and path == '/api/v3/uploads':
+      if form is None or 'file' not in form:
+        return self.reply(400, { 'message' : 'Bad Request' }, usage)
+      f    = form['file']
+      size = len(f.value)
+      ext  = form.getvalue('data_type', '')
+      name = form.getvalue('external_id') or f.filename or 'upload'
+      return self.reply(201, st.upload(name, size, ext), usage)
+    r = re.match('^/api/v3/uploads/(\d+)$', path)
+    if method == 'GET' and r:
+      with st.lock:
+        s = st.status(int(r.group(1)))
+      if s: return self.reply(200, s, usage)
+    return self.reply(404, { 'message' : 'Record Not Found' }, usage)
+
+  def do_GET ( self ):
+    self.handle_api('GET')
+
+  def do_POST ( self ):
+    self.handle_api('POST')
+
+#
+# Convert Strava time to unix time
+#
+def _epoch ( s ):
+  dt = datetime.datetime.strptime(s, '%Y-%m-%dT%H:%M:%SZ')
+  return (dt - datetime.datetime(1970, 1, 1)).total_seconds()
+
+class Server ( ThreadingMixIn, HTTPServer ):
+  daemon_threads      = True
+  allow_reuse_address = True
+
+  def __init__ ( self, addr, **opts ):
+    HTTPServer.__init__(self, addr, Handler)
+    self.state = State(**opts)
+
+  # Base URL (for the api_url option)
+  def url ( self ):
+    return 'http://%s:%d' % self.server_address
+
+#
+# Start stub server in a background thread
+#
+def start ( host = '127.0.0.1', port = 0, **opts ):
+  s = Server((host, port), **opts)
+  t = threading.Thread(target=s.serve_forever, name='StravaStub')
+  t.daemon = True
+  t.start()
+  return s
+
+# ###########################################################################
+# Main
+# ###########################################################################
+
+if __name__ == '__main__':
+  from optparse import OptionParser
+
+  # Command line
+  optp = OptionParser(usage='%prog [options]')
+  optp.add_option('-p', '--port', default=8080, type='int',
+                  help='Port to listen on')
+  optp.add_option('-l', '--latency', default='0', metavar='MIN[,MAX]',
+                  help='Response latency in seconds')
+  optp.add_option('-e', '--error-rate', default=0.0, type='float',
+                  help='Fraction of requests failing with 500')
+  optp.add_option('-d', '--dup-rate', default=0.0, type='float',
+                  help='Fraction of uploads rejected as duplicates')
+  optp.add_option('-P', '--process-time', default=0.0, type='float',
+                  help='Seconds before uploads are processed')
+  optp.add_option('-r', '--rate-limit', default='600,30000',
+                  metavar='15MIN,DAILY', help='Request limits')
+  (opts, args) = optp.parse_args()
+
+  lat = map(float, opts.latency.split(','))
+  s   = Server(('127.0.0.1', opts.port),
+               latency      = (lat[0], lat[-1]),
+               error_rate   = opts.error_rate,
+               dup_rate     = opts.dup_rate,
+               process_time = opts.process_time,
+               limits       = tuple(map(int, opts.rate_limit.split(','))))
+  print 'listening on %s (use -o api_url=\'"%s"\')' % (s.url(), s.url())
+  try:
+    s.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
@@ -22,190 +22,298 @@
 # ###########################################################################
 
 # System
-import os, sys, time, re
-import select
+import os, sys, time, re, json
 import threading
-import urlparse
-import gi
-gi.require_version('WebKit', '3.0')
-from gi.repository import Gtk, Gdk, WebKit, Soup
+from cStringIO import StringIO
 
 # Local
-import stravalib
-from log import log
+import stravalib, requests, requests.adapters
+import metrics, ratelimit
+from log import log, ERROR
 
-class Strava:
+API_URL = 'https://www.strava.com'
 
-  # Initialise
-  def __init__ ( self, conf ):
-    cid  = conf['client_id']
-    curl = conf['client_url']
+#
+# Shared HTTP session used for all API calls
+#
+# Connections are pooled and kept alive (pool_size per host), every request
+# gets a default timeout and, if url is given, API requests are redirected
+# to that server instead (see stravastub.py). Rate limit headers from every
+# response are passed to limiter.
+#
+class Session ( requests.Session ):
+
+  def __init__ ( self, pool_size = 4, timeout = 60.0, keepalive = True,
+                 url = None, limiter = None ):
+    requests.Session.__init__(self)
+    self._limiter = limiter
+    self._timeout = timeout
+    self._url     = url.rstrip('/') if url else None
+    for p in [ 'http://', 'https://' ]:
+      self.mount(p, requests.adapters.HTTPAdapter(pool_connections=2,
+                                                  pool_maxsize=pool_size))
+    if not keepalive:
+      self.headers['Connection'] = 'close'
+
+  def request ( self, method, url, *args, **kwargs ):
+    if self._url and url.startswith(API_URL):
+      url = self._url + url[len(API_URL):]
+    kwargs.setdefault('timeout', self._timeout)
+    r = requests.Session.request(self, method, url, *args, **kwargs)
+    if self._limiter:
+      self._limiter.update(r.headers)
+      if r.status_code == 429:
+        self._limiter.throttled(r.headers)
+    return r
 
-    self._conf    = conf
-    self._client  = stravalib.Client()
-    self._web     = WebKit.WebView()
-    self._win     = Gtk.Window()
-    self._authurl = self._client.authorization_url(client_id=cid,
-                                                   redirect_uri=curl,
-                                                   scope='write')
-
-    # Auth condition
-    self._authcv  = threading.Condition()
-
-    # Cookie processing
-    cpath     = os.path.expanduser(self._conf['cookiepath'])
-    cookiejar = Soup.CookieJarText.new(cpath, False)
-    cookiejar.set_accept_policy(Soup.CookieJarAcceptPolicy.ALWAYS)
-    session = WebKit.get_default_session()
-    session.add_feature(cookiejar)
-
-    # Setup Webkit callbacks
-    self._web.connect('load-committed', self.load_start)
-    self._web.connect('load-error',      self.load_error)
-
-    # Setup Web Window
-    self._win.set_title('Strava Authentication')
-    self._win.set_default_size(800, 600)
-
-    # Add browser
-    sw  = Gtk.ScrolledWindow()
-    sw.add(self._web)
-    self._win.add(sw)
-
-    # Event handlers
-    self._win.connect('delete-event', Gtk.main_quit)
-
-    # Hack (for some reason, not opening something here causes
-    # things to crash)
-    self._win.show_all()
-    self._web.open('http://strava.com')
-    self._win.hide()
-
-  # Error
-  def load_error ( self, web, frame, a, b ):
-    print 'ERROR: %s %s' % (a, b)
-    pass
-
-  # Callback on page load
-  def load_start ( self, web, frame ):
-    uri = frame.get_uri()
-    print uri
-
-    # Authenticated
-    if uri.startswith(self._conf['client_url']):
-      log('authenticated')
-      self._win.hide()
-      self._authtoken = None
-      
-      # Parse URL
-      parse  = urlparse.urlparse(uri)
-      params = urlparse.parse_qs(parse.query)
-      code   = params['code'][0]
-
-      # Get Token
-      cid             = self._conf['client_id']
-      csec            = self._conf['client_secret']
-      self._authtoken = self._client.exchange_code_for_token(client_id=cid,
-                                                             client_secret=csec,
-                                                             code=code)
-      # Done
-      self._authcv.acquire()
-      self._authcv.notify()
-      self._authcv.release()
-
-    # Not authenticated
-    elif 'strava.com/login' in uri or 'strava.com/oauth' in uri:
-      log('showing strava login window')
-      self._win.show_all()
+#
+# HTTP session for the API client
+#
+def session ( conf, limiter = None ):
+  return Session(pool_size = conf.get('http_pool_size', 4),
+                 timeout   = conf.get('http_timeout', 60.0),
+                 keepalive = conf.get('http_keepalive', True),
+                 url       = conf.get('api_url'),
+                 limiter   = limiter)
+
+#
+# Persistent token store
+#
+# Holds the access token plus (where the API provides them) the refresh
+# token and expiry time, so that validity can be checked locally without
+# an API round trip. Legacy files containing just the access token are
+# still accepted.
+#
+class TokenStore:
+
+  def __init__ ( self, path ):
+    self._path  = os.path.expanduser(path)
+    self._lock  = threading.Lock()
+    self.access = self.refresh = self.expires = None
+    self.load()
+
+  # Load from file
+  def load ( self ):
+    try:
+      data = open(self._path).read().strip()
+    except IOError:
       return
+    try:
+      tok = json.loads(data)
+    except ValueError:
+      tok = data
+    self._set(tok)
+
+  # Update from token (string or dict as returned by the API)
+  def _set ( self, tok ):
+    if isinstance(tok, dict):
+      self.access  = tok.get('access_token')
+      self.refresh = tok.get('refresh_token', self.refresh)
+      self.expires = tok.get('expires_at')
+    else:
+      self.access  = tok or None
+      self.refresh = self.expires = None
+
+  # Update and save
+  def update ( self, tok ):
+    with self._lock:
+      self._set(tok)
+      data = json.dumps({ 'access_token'  : self.access,
+                          'refresh_token' : self.refresh,
+                          'expires_at'    : self.expires })
+      try:
+        d = os.path.dirname(self._path)
+        if d and not os.path.exists(d):
+          os.makedirs(d)
+        tmp = self._path + '.tmp'
+        fd  = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        os.write(fd, data + '\n')
+        os.close(fd)
+        os.rename(tmp, self._path)
+      except Exception, e:
+        log('failed to save token', ERROR, e=e)
+
+  # Forget access token (e.g. rejected by the server)
+  def invalidate ( self ):
+    with self._lock:
+      self.access = None
+
+  # Access token usable for at least margin seconds
+  def valid ( self, margin = 0 ):
+    if not self.access: return False
+    return self.expires is None or self.expires - margin > time.time()
 
+#
+# Check for an authorisation failure
+#
+def unauthorized ( e ):
+  r = getattr(e, 'response', None)
+  if getattr(r, 'status_code', None) == 401: return True
+  return type(e).__name__ == 'AccessUnauthorized'
 
-  # Perform authentication
-  #
-  def _authenticate ( self ):
+class Strava:
 
-    # Open auth url
-    Gdk.threads_enter()
-    self._web.open(self._authurl)
-    Gdk.threads_leave()
+  # Initialise
+  #
+  # auth is the interactive authentication backend, anything with an
+  # authenticate() method returning a token (or None). If not specified
+  # the WebKit backend is used unless running headless.
+  #
+  def __init__ ( self, conf, auth = None ):
+    self._conf    = conf
+    self._limiter = ratelimit.Scheduler(conf.get('rate_limits', (600, 30000)))
+    self._client  = stravalib.Client(requests_session=session(conf,
+                                                              self._limiter))
+    self._auth    = auth
+    self._lock    = threading.Lock()
+
+    # Interactive authentication (imports GTK/WebKit)
+    if self._auth is None and not conf['headless']:
+      from webauth import WebAuth
+      self._auth = WebAuth(conf, self._client)
+
+    # Load stored token
+    self._tokens = TokenStore(conf['token_file'])
+    self._client.access_token = self._tokens.access
+
+  # Refresh access token
+  #
+  def _refresh ( self ):
+    if not self._tokens.refresh or\
+       not hasattr(self._client, 'refresh_access_token'):
+      return False
+    try:
+      metrics.count('api_calls', call='refresh_access_token')
+      tok = self._client.refresh_access_token(
+              client_id=self._conf['client_id'],
+              client_secret=self._conf['client_secret'],
+              refresh_token=self._tokens.refresh)
+    except Exception, e:
+      log('failed to refresh token', ERROR, e=e)
+      return False
+    log('token refreshed')
+    self._tokens.update(tok)
+    self._client.access_token = self._tokens.access
+    return True
 
-    # Wait
-    self._authcv.acquire()
-    self._authcv.wait()
-    self._authcv.release()
-    if not self._authtoken:
+  # Perform interactive authentication
+  #
+  def _authenticate ( self ):
+    if not self._auth:
+      log('no valid token and no interactive authentication available',
+          ERROR)
       return False
-    log('authenticated %s' % self._authtoken)
+    metrics.count('auth_interactive')
+    token = self._auth.authenticate()
+    if not token:
+      return False
+    log('authenticated')
+    self._tokens.update(token)
+    self._client.access_token = self._tokens.access
     return True
-    
+
   #
   # Authenticate
   #
+  # The stored token is checked locally, it is refreshed shortly before
+  # expiry and interactive authentication is only used if there is no
+  # usable token
+  #
   def authenticate ( self ):
-
-    # Check if already authenticated
-    try:
-      self._client.get_athlete()
-      #log('already authenticated')
-    except Exception, e:
+    with self._lock:
+      if self._tokens.valid(self._conf.get('token_refresh_margin', 300)):
+        return True
+      if self._refresh():
+        return True
+      if self._tokens.valid():
+        return True
       try:
-        if not self._authenticate():
-          return False
-      except:
+        return self._authenticate()
+      except Exception, e:
+        log('authentication failed', ERROR, e=e)
         return False
 
-    return True
-
   #
-  # Send activity
+  # Call the API, re-authenticating (once) if the token is rejected
   #
-  def send_activity ( self, path, type ):
-
-    # Authenticate
-    if not self.authenticate():
-      return False
+  # Each call waits for the rate limit scheduler at the given priority
+  #
+  def _call ( self, name, prio, fn, *args, **kwargs ):
+    for i in range(2):
+      if not self.authenticate():
+        raise Exception('not authenticated')
+      token = self._tokens.access
+      self._limiter.acquire(prio)
+      try:
+        metrics.count('api_calls', call=name)
+        return fn(*args, **kwargs)
+      except Exception, e:
+        if i or not unauthorized(e): raise
+        log('token rejected, re-authenticating')
+        with self._lock:
+          if self._tokens.access == token:
+            self._tokens.invalidate()
+      finally:
+        self._limiter.release()
 
-    # Send Activity
+  #
+  # Send activity (data is either the encoded activity or a file object)
+  #
+  # Returns the upload id (True if the API did not provide one), or False
+  # on failure. Processing status can be checked with upload_status().
+  #
+  def send_activity ( self, data, type ):
     try:
-      self._client.upload_activity(open(path), type)
-      log('activity submitted')
-      return True
+      if not hasattr(data, 'read'):
+        data = StringIO(data)
+
+      # Rewound on each attempt (a retry after a rejected token would
+      # otherwise send the data already read)
+      def upload ():
+        data.seek(0)
+        return self._client.upload_activity(data, type)
+      up = self._call('upload_activity', ratelimit.UPLOAD, upload)
+      uid = getattr(up, 'upload_id', None)
+      log('activity submitted', upload=uid)
+      return uid or True
     except Exception, e:
-      import traceback
-      traceback.print_exc(e)
-      log('failed to upload [e=%s]' % e)
+      log('failed to upload', ERROR, e=e)
   
     return False
+
+  #
+  # Get upload processing status (dict with id, status, error, activity_id)
+  #
+  def upload_status ( self, upload_id ):
+    return self._call('upload_status', ratelimit.STATUS,
+                      self._client.protocol.get, '/uploads/{id}',
+                      id=upload_id)
   
   #
   # Send TCX
   #
-  def send_tcx ( self, path ):
-    return self.send_activity(path, 'tcx')
+  def send_tcx ( self, data ):
+    return self.send_activity(data, 'tcx')
 
   #
   # Send FIT
   #
-  def send_fit ( self, path ):
-    return self.send_activity(path, 'fit')
+  def send_fit ( self, data ):
+    return self.send_activity(data, 'fit')
 
   #
   # Send GPX
   #
-  def send_gpx ( self, path ):
-    return self.send_activity(path, 'gpx')
+  def send_gpx ( self, data ):
+    return self.send_activity(data, 'gpx')
 
   #
   # Get activities
   #
   def get_activities ( self, beg = None, end = None, limit = None ):
-
-    # Authenticate
-    if not self.authenticate():
-      return None
-
-    # Fetch
-    return self._client.get_activities(before=end, after=beg, limit=limit)
+    return self._call('get_activities', ratelimit.LOOKUP, lambda:
+                      list(self._client.get_activities(before=end, after=beg,
+                                                       limit=limit)))
       
 # ###########################################################################
 # Testing
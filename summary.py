@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+#
+# summary.py - Per-track summary statistics and queries
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, time, json
+import threading
+
+# Local
+import track
+from log import log
+
+# ###########################################################################
+# Statistics
+# ###########################################################################
+
+MOVING_SPEED = 3.0  # km/h
+MAX_GAP      = 30   # seconds, longer gaps are never moving time
+CLIMB        = 2.0  # m, elevation hysteresis
+
+#
+# Min/avg/max of a channel
+#
+class Channel:
+
+  def __init__ ( self ):
+    self.n   = 0
+    self.sum = 0.0
+    self.min = None
+    self.max = None
+
+  def add ( self, v ):
+    self.n   += 1
+    self.sum += v
+    if self.min is None or v < self.min: self.min = v
+    if self.max is None or v > self.max: self.max = v
+
+  def result ( self ):
+    if not self.n: return None
+    return { 'min' : self.min, 'avg' : self.sum / self.n, 'max' : self.max }
+
+#
+# Summary accumulator, fed one point at a time (see track.fixup)
+#
+class Summary:
+
+  def __init__ ( self ):
+    self.start    = None
+    self.end      = None
+    self.distance = 0.0
+    self.moving   = 0
+    self.gain     = 0.0
+    self.static   = False
+    self.bbox     = None
+    self._prev    = None
+    self._ref     = None
+    self._chan    = dict((k, Channel()) for k in
+                         [ 'speed', 'heartrate', 'cadence', 'temperature' ])
+
+  #
+  # Add point, dd is the distance (km) from the previous point if known,
+  # otherwise the point's cumulative distance is used
+  #
+  def add ( self, p, dd = None ):
+    ts = p['timestamp']
+    if self.start is None: self.start = ts
+    self.end = ts
+
+    # Distance
+    if dd is not None:
+      self.distance += dd
+    elif 'distance' in p:
+      self.distance  = p['distance']
+
+    # Moving time
+    spd = p.get('speed')
+    if self._prev is not None and spd is not None and spd >= MOVING_SPEED:
+      dt = ts - self._prev
+      if dt <= MAX_GAP: self.moving += dt
+    self._prev = ts
+
+    # Elevation gain (ignoring changes below the hysteresis)
+    alt = p.get('altitude')
+    if alt is not None:
+      if self._ref is None or alt < self._ref:
+        self._ref = alt
+      elif alt - self._ref >= CLIMB:
+        self.gain += alt - self._ref
+        self._ref  = alt
+
+    # Bounding box
+    if 'latitude' in p:
+      lat, lon = p['latitude'], p['longitude']
+      b = self.bbox
+      if b is None:
+        self.bbox = [ lat, lon, lat, lon ]
+      else:
+        if lat < b[0]: b[0] = lat
+        if lon < b[1]: b[1] = lon
+        if lat > b[2]: b[2] = lat
+        if lon > b[3]: b[3] = lon
+
+    # Channels
+    for k, c in self._chan.iteritems():
+      if k in p: c.add(p[k])
+
+  #
+  # Summary dictionary
+  #
+  def result ( self ):
+    ret = {
+      'start'     : self.start,
+      'end'       : self.end,
+      'duration'  : (self.end - self.start) if self.start is not None else 0,
+      'distance'  : self.distance,
+      'moving'    : self.moving,
+      'gain'      : self.gain,
+      'static'    : self.static,
+      'bbox'      : self.bbox,
+      'avg_speed' : self.distance / self.moving * 3600.0 if self.moving\
+                    else 0.0,
+    }
+    for k, c in self._chan.iteritems():
+      ret[k] = c.result()
+    ret['max_speed'] = ret['speed']['max'] if ret['speed'] else 0.0
+    del ret['speed']
+    return ret
+
+#
+# Summarise an already fixed up track (e.g. loaded from the cache)
+#
+def summarize ( t ):
+  s        = Summary()
+  s.static = t['static']
+  prev     = None
+  for p in t['track']:
+    dd = None
+    if not t['static'] and 'latitude' in p:
+      if prev is not None:
+        dd = abs(track.haversine(prev['longitude'], prev['latitude'],
+                                 p['longitude'], p['latitude']))
+      prev = p
+    s.add(p, dd)
+  return s.result()
+
+# ###########################################################################
+# Index
+# ###########################################################################
+
+#
+# Persistent index of track summaries (by track file name)
+#
+# Stored as an append-only file with one line per summary:
+#
+#   name json
+#
+# a later line for the same name replaces the earlier one. Older versions
+# stored a single JSON object, which is converted on load.
+#
+class SummaryIndex:
+
+  def __init__ ( self, path ):
+    self._path = os.path.expanduser(path)
+    self._lock = threading.Lock()
+    self._data = {}
+    legacy     = None
+    try:
+      for l in open(self._path):
+        try:
+          if l.startswith('{'):
+            legacy = json.loads(l)
+            self._data.update(legacy)
+          elif l.strip():
+            n, j = l.split(' ', 1)
+            self._data[n] = json.loads(j)
+        except ValueError, e:
+          log('summary: ignoring corrupt entry in %s [e=%s]' %\
+              (self._path, e))
+    except IOError:
+      pass
+
+    # Convert older index
+    if legacy:
+      self.compact()
+      log('summary: converted %s (%d summaries)' % (self._path, len(legacy)))
+
+  def __len__ ( self ):
+    return len(self._data)
+
+  def get ( self, name ):
+    with self._lock:
+      return self._data.get(name)
+
+  def items ( self ):
+    with self._lock:
+      return self._data.items()
+
+  # Format entry
+  def _format ( self, name, summary ):
+    return '%s %s\n' % (name, json.dumps(summary))
+
+  # Add summaries (dict name -> summary), appending them to the file
+  def update ( self, summaries ):
+    if not summaries: return
+    with self._lock:
+      self._data.update(summaries)
+      d = os.path.dirname(self._path)
+      if d and not os.path.exists(d):
+        os.makedirs(d)
+      fp = open(self._path, 'a')
+      try:
+        fp.write(''.join(self._format(n, s)
+                         for n, s in sorted(summaries.items())))
+      finally:
+        fp.close()
+
+  def add ( self, name, summary ):
+    self.update({ name : summary })
+
+  # Rewrite file from memory (dropping replaced entries)
+  def compact ( self ):
+    with self._lock:
+      d = os.path.dirname(self._path)
+      if d and not os.path.exists(d):
+        os.makedirs(d)
+      tmp = self._path + '.tmp'
+      open(tmp, 'w').write(''.join(self._format(n, s)
+                                   for n, s in sorted(self._data.items())))
+      os.rename(tmp, self._path)
+
+# ###########################################################################
+# Queries
+# ###########################################################################
+
+#
+# Filter summaries
+#
+def query ( items, since = None, until = None, min_distance = None,
+            has = [] ):
+  for n, s in items:
+    if since is not None and s['start'] < since: continue
+    if until is not None and s['start'] >= until: continue
+    if min_distance is not None and s['distance'] < min_distance: continue
+    if any(not s.get(k) for k in has): continue
+    yield n, s
+
+#
+# Aggregate totals
+#
+def totals ( items ):
+  ret = { 'rides' : 0, 'distance' : 0.0, 'duration' : 0, 'moving' : 0,
+          'gain' : 0.0, 'longest' : None }
+  for n, s in items:
+    ret['rides']    += 1
+    ret['distance'] += s['distance']
+    ret['duration'] += s['duration']
+    ret['moving']   += s['moving']
+    ret['gain']     += s['gain']
+    if ret['longest'] is None or s['distance'] > ret['longest'][1]['distance']:
+      ret['longest'] = (n, s)
+  return ret
+
+# ###########################################################################
+# Main
+# ###########################################################################
+
+if __name__ == '__main__':
+  from optparse import OptionParser
+  import trackfile
+
+  # Parse date (YYYY-MM-DD or YYYY-MM, local time)
+  def date ( s ):
+    for f in [ '%Y-%m-%d', '%Y-%m' ]:
+      try:
+        return time.mktime(time.strptime(s, f))
+      except ValueError: pass
+    raise ValueError('invalid date %s' % s)
+
+  # Format seconds
+  def hms ( s ):
+    return '%d:%02d:%02d' % (s // 3600, (s // 60) % 60, s % 60)
+
+  # Command line
+  optp = OptionParser(usage='%prog [options]')
+  optp.add_option('-i', '--index', default='~/.bryton/summary.json',
+                  help='Summary index')
+  optp.add_option('--rebuild', default=None, metavar='DIR',
+                  help='(Re)build index from the track cache in DIR')
+  optp.add_option('-s', '--since', default=None, help='Start date')
+  optp.add_option('-u', '--until', default=None, help='End date')
+  optp.add_option('-d', '--min-distance', default=None, type='float',
+                  help='Minimum distance (km)')
+  optp.add_option('--has', default=[], action='append',
+                  choices=[ 'heartrate', 'cadence', 'temperature', 'bbox' ],
+                  help='Require channel data')
+  optp.add_option('--sort', default='start',
+                  help='Sort rides by field (e.g. distance, gain)')
+  optp.add_option('-n', '--limit', default=None, type='int',
+                  help='Show at most N rides')
+  optp.add_option('-t', '--totals', default=False, action='store_true',
+                  help='Show totals only')
+  (opts, args) = optp.parse_args()
+
+  idx = SummaryIndex(opts.index)
+
+  # Rebuild
+  if opts.rebuild:
+    d   = os.path.expanduser(opts.rebuild)
+    new = {}
+    for f in sorted(os.listdir(d)):
+      if f.endswith('.track') and idx.get(f) is None:
+        new[f] = summarize(trackfile.load(os.path.join(d, f)))
+    idx.update(new)
+    idx.compact()
+    print 'indexed %d tracks (%d total)' % (len(new), len(idx))
+
+  # Query
+  t0  = time.time()
+  res = list(query(idx.items(),
+                   since        = date(opts.since) if opts.since else None,
+                   until        = date(opts.until) if opts.until else None,
+                   min_distance = opts.min_distance,
+                   has          = opts.has))
+  tot = totals(res)
+  dt  = time.time() - t0
+
+  # Output
+  if not opts.totals:
+    res.sort(key=lambda r: r[1].get(opts.sort), reverse=opts.sort != 'start')
+    for n, s in res[:opts.limit]:
+      hr = s['heartrate']['avg'] if s['heartrate'] else None
+      print '%s %8.2fkm %s %6.1fkm/h %6.0fm %s' %\
+            (time.strftime('%F %T', time.localtime(s['start'])),
+             s['distance'], hms(s['duration']), s['avg_speed'], s['gain'],
+             'hr=%.0f' % hr if hr else '')
+  print 'rides %d, distance %.1fkm, time %s (moving %s), climb %.0fm' %\
+        (tot['rides'], tot['distance'], hms(tot['duration']),
+         hms(tot['moving']), tot['gain'])
+  if tot['longest']:
+    print 'longest %s (%.1fkm)' % (tot['longest'][0],
+                                   tot['longest'][1]['distance'])
+  print 'query took %.1fms over %d rides' % (dt * 1000, len(idx))
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#
+# tcx.py - TCX file generator
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+import time, datetime
+
+# Local
+import export
+from export import time2isoformat
+
+# Encoder version (bump whenever the output changes, see exportcache.py)
+VERSION = 1
+
+# ###########################################################################
+# Functions
+# ###########################################################################
+
+#
+# TCX activity sink (see export.py)
+#
+# The lap header needs the total time and distance, so it is only written
+# once the last point has been seen
+#
+class TcxSink:
+
+  NEEDS = set([ 'iso', 'mps', 'dist' ])
+
+  def begin ( self, first, static ):
+    self._static = static
+    self._first  = first['timestamp']
+    self._last   = first['timestamp']
+    self._dist   = 0.0
+    self._out    = []
+
+  # Track point
+  def point ( self, p, c ):
+    tcx  = '          <Trackpoint>\n'
+    tcx += '            <Time>%s</Time>\n' % c['iso']
+    if not self._static:
+      tcx += '            <Position>\n'
+      tcx += '              <LatitudeDegrees>%0.6f</LatitudeDegrees>\n' % p['latitude']
+      tcx += '              <LongitudeDegrees>%0.6f</LongitudeDegrees>\n' % p['longitude']
+      tcx += '            </Position>\n'
+      tcx += '            <AltitudeMeters>%0.6f</AltitudeMeters>\n' % p['altitude']
+    tcx += '            <DistanceMeters>%0.2f</DistanceMeters>\n' % c['dist']
+    if 'heartrate' in p:
+      tcx += '            <HeartRateBpm><Value>%d</Value></HeartRateBpm>\n' % p['heartrate']
+    if 'cadence' in p:
+      tcx += '            <Cadence>%d</Cadence>\n' % p['cadence']
+    if 'speed' in p:
+      tcx += '            <Extensions>\n'
+      tcx += '              <ns3:TPX>\n'
+      tcx += '                <ns3:Speed>%0.3f</ns3:Speed>\n' % c['mps']
+      tcx += '              </ns3:TPX>\n'
+      tcx += '            </Extensions>\n'
+    tcx += '          </Trackpoint>\n'
+    self._out.append(tcx)
+    self._last = p['timestamp']
+    self._dist = c['dist']
+
+  def end ( self ):
+
+    # Header
+    start = time2isoformat(self._first)
+    tcx  = '<?xml version="1.0" encoding="UTF-8" standalone="no" ?>\n'
+    tcx += '<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2" xmlns:ns3="http://www.garmin.com/xmlschemas/ActivityExtension/v2" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2 http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd">\n'
+    tcx += '  <Activities>\n'
+    tcx += '    <Activity Sport="Biking">\n'
+    tcx += '      <Id>%s</Id>\n' % start
+
+    # Lap Begin
+    tcx += '      <Lap StartTime="%s">\n' % start
+    tcx += '        <TotalTimeSeconds>%d</TotalTimeSeconds>\n' %\
+           (self._last - self._first)
+    tcx += '        <DistanceMeters>%0.2f</DistanceMeters>\n' % self._dist
+    tcx += '        <Calories>0</Calories>\n'
+    tcx += '        <Intensity>Active</Intensity>\n'
+    tcx += '        <TriggerMethod>Manual</TriggerMethod>\n'
+    tcx += '        <Track>\n'
+    self._out.insert(0, tcx)
+
+    # Lap End / Footer
+    tcx  = '        </Track>\n'
+    tcx += '      </Lap>\n'
+    tcx += '    </Activity>\n'
+    tcx += '  </Activities>\n'
+    tcx += '</TrainingCenterDatabase>\n'
+    self._out.append(tcx)
+    ret, self._out = ''.join(self._out), None
+    return ret
+
+#
+# Output TCX activity
+#
+
+def tcx_activity ( track, static = False ):
+  return export.run(track, static, [ TcxSink() ])[0]
+
+# ###########################################################################
+# Main
+# ###########################################################################
+
+if __name__ == '__main__':
+  from optparse import OptionParser
+  import os
+  import trackfile, profiling
+
+  # Command line
+  optp = OptionParser()
+  optp.add_option('--profile', default=None, metavar='DIR',
+                  help='Write CPU/memory profile to DIR')
+  (opts, args) = optp.parse_args()
+  if opts.profile:
+    profiling.configure(opts.profile)
+    profiling.begin(os.path.splitext(os.path.basename(args[0]))[0])
+
+  # Load track
+  with profiling.stage('load'):
+    track = trackfile.load(args[0])
+
+  # Convert to TCX
+  with profiling.stage('encode_tcx'):
+    tcx = tcx_activity(track['track'], track['static'])
+  profiling.end()
+
+  # Output to file
+  if len(args) > 1:
+    open(args[1], 'w').write(tcx)
+  
+  # Output to stdout
+  else:
+    print tcx
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
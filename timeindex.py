@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+#
+# timeindex.py - Start time index of the track cache
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, time
+import threading, bisect
+
+# Local
+import trackfile
+from log import log
+
+# ###########################################################################
+# Index
+# ###########################################################################
+
+#
+# Sorted (start, end, name) index of cached tracks
+#
+# Stored as an append-only file of "start end name" lines, so adding a
+# track is a single append. The file is rewritten (sorted) by rebuild().
+#
+class TimeIndex:
+
+  def __init__ ( self, path ):
+    self._path   = os.path.expanduser(path)
+    self._lock   = threading.Lock()
+    self._starts = []    # sorted start times
+    self._ents   = []    # (start, end, name) in the same order
+    self._names  = {}    # name -> start
+    self._maxdur = 0
+    try:
+      for l in open(self._path):
+        p = l.split()
+        if len(p) == 3:
+          self._insert(int(p[0]), int(p[1]), p[2])
+    except IOError:
+      pass
+
+  # Check if index file exists
+  def exists ( self ):
+    return os.path.exists(self._path)
+
+  def __len__ ( self ):
+    return len(self._ents)
+
+  def __contains__ ( self, name ):
+    return name in self._names
+
+  # Insert entry (replacing any previous entry for name)
+  def _insert ( self, beg, end, name ):
+    if name in self._names:
+      self._remove(name)
+    i = bisect.bisect_right(self._starts, beg)
+    self._starts.insert(i, beg)
+    self._ents.insert(i, (beg, end, name))
+    self._names[name] = beg
+    self._maxdur = max(self._maxdur, end - beg)
+
+  # Remove entry
+  def _remove ( self, name ):
+    beg = self._names.pop(name)
+    i   = bisect.bisect_left(self._starts, beg)
+    while self._ents[i][2] != name:
+      i += 1
+    del self._starts[i]
+    del self._ents[i]
+
+  #
+  # Add track
+  #
+  def add ( self, name, beg, end ):
+    beg, end = int(beg), int(end)
+    with self._lock:
+      self._insert(beg, end, name)
+      d = os.path.dirname(self._path)
+      if d and not os.path.exists(d):
+        os.makedirs(d)
+      fp = open(self._path, 'a')
+      try:
+        fp.write('%d %d %s\n' % (beg, end, name))
+      finally:
+        fp.close()
+
+  #
+  # Rebuild from track directory
+  #
+  def rebuild ( self, tdir ):
+    ents = []
+    for f in os.listdir(tdir):
+      if not f.endswith('.track'): continue
+      try:
+        h = trackfile.header(os.path.join(tdir, f))
+        ents.append((int(h['timestamp']), int(h['end']), f))
+      except Exception, e:
+        log('timeindex: skipping %s [e=%s]' % (f, e))
+    ents.sort()
+    with self._lock:
+      self._starts = [ e[0] for e in ents ]
+      self._ents   = ents
+      self._names  = dict((e[2], e[0]) for e in ents)
+      self._maxdur = max([ e[1] - e[0] for e in ents ] or [ 0 ])
+      tmp = self._path + '.tmp'
+      open(tmp, 'w').write(''.join('%d %d %s\n' % e for e in ents))
+      os.rename(tmp, self._path)
+    log('timeindex: indexed %d tracks' % len(ents))
+
+  #
+  # Reconcile with track directory, indexing tracks missing from the index
+  # (e.g. copied in while not running) and dropping removed tracks
+  #
+  # Returns the names of all tracks in the directory (oldest first)
+  #
+  def reconcile ( self, tdir ):
+    names = sorted(f for f in os.listdir(tdir) if f.endswith('.track'))
+    with self._lock:
+      missing = [ n for n in names if n not in self._names ]
+      stale   = set(self._names) - set(names)
+    for n in missing:
+      try:
+        h = trackfile.header(os.path.join(tdir, n))
+        self.add(n, h['timestamp'], h['end'])
+      except Exception, e:
+        log('timeindex: skipping %s [e=%s]' % (n, e))
+
+    # Stale tracks are checked again with the lock held, so a track cached
+    # since the directory was listed is kept
+    removed = 0
+    if stale:
+      with self._lock:
+        for n in stale:
+          if n not in self._names: continue
+          if os.path.exists(os.path.join(tdir, n)): continue
+          self._remove(n)
+          removed += 1
+        if removed:
+          self._maxdur = max([ e[1] - e[0] for e in self._ents ] or [ 0 ])
+          tmp = self._path + '.tmp'
+          open(tmp, 'w').write(''.join('%d %d %s\n' % e for e in self._ents))
+          os.rename(tmp, self._path)
+    if missing or removed:
+      log('timeindex: added %d, removed %d tracks' % (len(missing), removed))
+    return names
+
+  #
+  # All track names (oldest first)
+  #
+  def names ( self ):
+    with self._lock:
+      return [ e[2] for e in self._ents ]
+
+  #
+  # Tracks starting in [beg, end)
+  #
+  def range ( self, beg, end ):
+    with self._lock:
+      i = bisect.bisect_left(self._starts, beg)
+      j = bisect.bisect_left(self._starts, end)
+      return self._ents[i:j]
+
+  #
+  # Tracks overlapping [beg, end]
+  #
+  def overlapping ( self, beg, end ):
+    with self._lock:
+      i = bisect.bisect_left(self._starts, beg - self._maxdur)
+      j = bisect.bisect_right(self._starts, end)
+      return [ e for e in self._ents[i:j] if e[1] >= beg ]
+
+# ###########################################################################
+# Main
+# ###########################################################################
+
+if __name__ == '__main__':
+  from optparse import OptionParser
+
+  # Command line
+  optp = OptionParser(usage='%prog [options] [BEGIN END]')
+  optp.add_option('-i', '--index', default='~/.bryton/tracks.idx',
+                  help='Index file')
+  optp.add_option('--rebuild', default=None, metavar='DIR',
+                  help='Rebuild index from track cache in DIR')
+  (opts, args) = optp.parse_args()
+
+  idx = TimeIndex(opts.index)
+  if opts.rebuild:
+    idx.rebuild(os.path.expanduser(opts.rebuild))
+
+  # Overlap query (YYYY-MM-DD[THH:MM], local time)
+  def parse ( s ):
+    for f in [ '%Y-%m-%dT%H:%M', '%Y-%m-%d' ]:
+      try:
+        return time.mktime(time.strptime(s, f))
+      except ValueError: pass
+    raise ValueError('invalid time %s' % s)
+  if len(args) == 2:
+    t0  = time.time()
+    res = idx.overlapping(parse(args[0]), parse(args[1]))
+    dt  = time.time() - t0
+    for b, e, n in res:
+      print '%s %s %s' % (time.strftime('%F %T', time.localtime(b)),
+                          time.strftime('%F %T', time.localtime(e)), n)
+    print '%d of %d tracks (%.2fms)' % (len(res), len(idx), dt * 1000)
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
@@ -52,23 +52,21 @@ def haversine(lon1, lat1, lon2, lat2):
 #
 # I.e. no segments etc.. and combiend track and lap points
 #
+# Points are yielded as the segments are consumed
+#
 
-def convert ( track ):
+def points ( segments ):
   ptp   = None # previous track point
-  start = None
-  ret   = []
   dist  = 0.0
   plp   = None
 
-  for seg in track:
+  for seg in segments:
     for tp, lp in seg:
       if not lp: continue # faulty (very rare)
       if tp and tp.timestamp != lp.timestamp: continue # faulty
-      if not start:
-        start = lp.timestamp
       if plp and lp.speed is not None:
         t = lp.timestamp - plp.timestamp
-        dist += lp.speed * t
+        dist += (lp.speed * t) / 3600.0
       d = {
         'timestamp' : lp.timestamp,
       }
@@ -86,21 +84,35 @@ def convert ( track ):
         d['speed']       = lp.speed
       if dist:
         d['distance']    = dist
-      ret.append(d)
+      yield d
       plp = lp
 
+#
+# Convert segments to a track (segments may be any iterable, e.g. streamed
+# from the device)
+#
+def convert ( segments ):
+  ret   = list(points(segments))
+  start = ret[0]['timestamp'] if ret else None
   return { 'timestamp' : start, 'track' : ret, 'static' : False }
 
 #
 # Perform all fixups on a track
 #
-def fixup ( track, conf ):
+# If stats is given (see summary.Summary) each point of the final track is
+# added to it, in the same pass as the speed calculation
+#
+def fixup ( track, conf, stats = None ):
   track = fixup_static(track, conf)
   if not track['static']:
     track = fixup_crop(track, conf)
     track = fixup_missing(track, conf)
     track = fixup_extrapolate(track, conf)
-    track = fixup_speed(track, conf)
+    track = fixup_speed(track, conf, stats)
+  elif stats:
+    stats.static = True
+    for p in track['track']:
+      stats.add(p)
   track['timestamp'] = track['track'][0]['timestamp']
   return track
 
@@ -124,7 +136,7 @@ def fixup_static ( track, conf ):
 #
 # Calculate the speed at each pint
 #
-def fixup_speed ( track, conf ):
+def fixup_speed ( track, conf, stats = None ):
   prev = None
   for p in track['track']:
     if 'latitude' not in p: continue
@@ -136,6 +148,7 @@ def fixup_speed ( track, conf ):
       p['speed'] = (dd / dt) * 3600.0
     else:
       p['speed'] = 0
+    if stats: stats.add(p, dd)
     prev = p
   return track
 
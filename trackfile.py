@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+#
+# trackfile.py - Binary track cache format
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, struct, mmap, json
+
+# Local
+import track, compress
+
+# ###########################################################################
+# Format
+# ###########################################################################
+
+#
+# File layout (all little endian):
+#
+#   header   - magic, version, flags, channel mask, point count,
+#              start time, end time, distance (km)
+#   columns  - one packed array of doubles per channel present in the
+#              mask (in CHANNELS order), count entries each. Points that
+#              do not have a value for a channel store NaN. If all
+#              timestamps are whole seconds (FLAG_INTTIME) the timestamp
+#              column is stored as 64-bit integers instead.
+#
+# Static rides cached before FLAG_KMDIST stored distance as km/h * s
+# rather than km, these (and legacy JSON static rides) are corrected when
+# read.
+#
+
+MAGIC    = 'BRTK'
+VERSION  = 1
+HEADER   = struct.Struct('<4sBBHIddd')
+
+FLAG_STATIC  = 0x01
+FLAG_INTTIME = 0x02
+FLAG_KMDIST  = 0x04
+
+CHANNELS = [
+  'timestamp',
+  'latitude',
+  'longitude',
+  'altitude',
+  'temperature',
+  'heartrate',
+  'cadence',
+  'speed',
+  'distance',
+]
+
+NAN = float('nan')
+
+# ###########################################################################
+# Helpers
+# ###########################################################################
+
+#
+# Check whether file content is in the binary format
+#
+def is_binary ( data ):
+  return data[:len(MAGIC)] == MAGIC
+
+#
+# Compute summary distance (km)
+#
+def _distance ( t ):
+  pts = t['track']
+  if not pts: return 0.0
+  if t['static']:
+    return pts[-1].get('distance', 0.0)
+  dist = 0.0
+  prev = None
+  for p in pts:
+    if 'latitude' not in p: continue
+    if prev is not None:
+      dist += abs(track.haversine(prev['longitude'], prev['latitude'],
+                                  p['longitude'], p['latitude']))
+    prev = p
+  return dist
+
+#
+# Correct distance of static rides cached with km/h * s units
+#
+def _fix_distance ( t ):
+  if t['static']:
+    for p in t['track']:
+      if 'distance' in p: p['distance'] /= 3600.0
+  return t
+
+#
+# Unpack header into a dictionary
+#
+def _header ( data ):
+  magic, ver, flags, mask, count, beg, end, dist = HEADER.unpack_from(data)
+  if magic != MAGIC:
+    raise ValueError('not a binary track file')
+  if ver != VERSION:
+    raise ValueError('unsupported track file version %d' % ver)
+  if flags & FLAG_INTTIME:
+    beg, end = int(beg), int(end)
+  if flags & FLAG_STATIC and not flags & FLAG_KMDIST:
+    dist /= 3600.0
+  return {
+    'version'   : ver,
+    'flags'     : flags,
+    'static'    : bool(flags & FLAG_STATIC),
+    'mask'      : mask,
+    'count'     : count,
+    'timestamp' : beg,
+    'end'       : end,
+    'distance'  : dist,
+  }
+
+# ###########################################################################
+# Encode / Decode
+# ###########################################################################
+
+#
+# Column format
+#
+def _fmt ( k, flags, n ):
+  if k == 'timestamp' and flags & FLAG_INTTIME:
+    return '<%dq' % n
+  return '<%dd' % n
+
+#
+# Encode track, yielding the header and then each column
+#
+def encode ( t ):
+  pts  = t['track']
+  n    = len(pts)
+  keys = [ k for k in CHANNELS if any(k in p for p in pts) ]
+  mask = 0
+  for k in keys:
+    mask |= (1 << CHANNELS.index(k))
+
+  # Flags
+  flags = FLAG_KMDIST | (FLAG_STATIC if t['static'] else 0)
+  if all(type(p['timestamp']) in (int, long) for p in pts):
+    flags |= FLAG_INTTIME
+
+  # Header
+  beg   = pts[0]['timestamp']  if pts else 0
+  end   = pts[-1]['timestamp'] if pts else 0
+  yield HEADER.pack(MAGIC, VERSION, flags, mask, n, beg, end, _distance(t))
+
+  # Columns
+  for k in keys:
+    yield struct.pack(_fmt(k, flags, n), *[p.get(k, NAN) for p in pts])
+
+#
+# Decode track, read(fmt) must return the next column unpacked
+#
+def decode ( hdr, read ):
+  n    = hdr['count']
+  keys = []
+  cols = []
+  gaps = []
+
+  # Unpack columns
+  for i, k in enumerate(CHANNELS):
+    if not (hdr['mask'] & (1 << i)): continue
+    vals = read(_fmt(k, hdr['flags'], n))
+    keys.append(k)
+    cols.append(vals)
+    if any(v != v for v in vals): # NaN
+      gaps.append(k)
+
+  # Build points (removing missing values)
+  pts = [ dict(zip(keys, r)) for r in zip(*cols) ]
+  for k in gaps:
+    for p in pts:
+      if p[k] != p[k]: del p[k]
+
+  t = {
+    'timestamp' : hdr['timestamp'],
+    'static'    : hdr['static'],
+    'track'     : pts
+  }
+  if not hdr['flags'] & FLAG_KMDIST:
+    _fix_distance(t)
+  return t
+
+#
+# Encode track to binary string
+#
+def dumps ( t ):
+  return ''.join(encode(t))
+
+#
+# Decode binary track from string/buffer (e.g. mmap) without copying
+#
+def loads ( data ):
+  off = [ HEADER.size ]
+  def read ( fmt ):
+    ret     = struct.unpack_from(fmt, data, off[0])
+    off[0] += struct.calcsize(fmt)
+    return ret
+  return decode(_header(data), read)
+
+#
+# Write track to (possibly compressed) file object, one column at a time
+#
+def dump ( t, fp ):
+  for c in encode(t):
+    fp.write(c)
+
+#
+# Read track from (possibly compressed) file object, one column at a time
+#
+def load_stream ( fp ):
+  def read ( fmt ):
+    return struct.unpack(fmt, fp.read(struct.calcsize(fmt)))
+  return decode(_header(fp.read(HEADER.size)), read)
+
+# ###########################################################################
+# File access
+# ###########################################################################
+
+#
+# Save track (optionally compressed, see compress.codecs())
+#
+# Written to a temporary file and renamed into place so that watchers
+# never see a partial file
+#
+def save ( path, t, codec = None ):
+  tmp = path + '.tmp'
+  fp  = compress.open_write(tmp, codec)
+  try:
+    dump(t, fp)
+  finally:
+    fp.close()
+  os.rename(tmp, path)
+
+#
+# Load track (binary, compressed binary or legacy JSON)
+#
+# Uncompressed files are decoded directly from an mmap
+#
+def load ( path ):
+
+  # Compressed (streamed)
+  if compress.compressed(path):
+    fp = compress.open_read(path)
+    try:
+      return load_stream(fp)
+    finally:
+      fp.close()
+
+  # Uncompressed
+  fp = open(path, 'rb')
+  try:
+    if not is_binary(fp.read(len(MAGIC))):
+      fp.seek(0)
+      return _fix_distance(json.loads(fp.read()))
+    mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      return loads(mm)
+    finally:
+      mm.close()
+  finally:
+    fp.close()
+
+#
+# Read track metadata only
+#
+# For legacy JSON files the whole file must be parsed
+#
+def header ( path ):
+  fp = compress.open_read(path)
+  try:
+    data = fp.read(HEADER.size)
+    if is_binary(data):
+      return _header(data)
+    t = _fix_distance(json.loads(data + fp.read()))
+  finally:
+    fp.close()
+  return {
+    'version'   : 0,
+    'flags'     : 0,
+    'static'    : t['static'],
+    'mask'      : 0,
+    'count'     : len(t['track']),
+    'timestamp' : t['track'][0]['timestamp'],
+    'end'       : t['track'][-1]['timestamp'],
+    'distance'  : _distance(t),
+  }
+
+#
+# Migrate a legacy JSON track file to binary format (in place), optionally
+# compressing it
+#
+def migrate ( path, codec = None ):
+  fp = compress.open_read(path)
+  try:
+    data = fp.read()
+  finally:
+    fp.close()
+  if is_binary(data) and\
+     (compress.compressed(path) or not codec): return False
+  if is_binary(data):
+    t = loads(data)
+  else:
+    t = _fix_distance(json.loads(data))
+  save(path, t, codec)
+  return True
+
+# ###########################################################################
+# Main
+# ###########################################################################
+
+if __name__ == '__main__':
+  from optparse import OptionParser
+
+  # Command line
+  optp = OptionParser(usage='%prog [options] dir|file ...')
+  optp.add_option('-i', '--info', default=False, action='store_true',
+                  help='Show header information only')
+  optp.add_option('-z', '--compress', default=None,
+                  help='Compress migrated files (%s)' %\
+                       ', '.join(compress.codecs()))
+  (opts, args) = optp.parse_args()
+
+  # Find files
+  paths = []
+  for a in args:
+    a = os.path.expanduser(a)
+    if os.path.isdir(a):
+      for f in sorted(os.listdir(a)):
+        if f.endswith('.track'):
+          paths.append(os.path.join(a, f))
+    else:
+      paths.append(a)
+
+  # Process
+  for p in paths:
+    if opts.info:
+      print '%s: %s' % (p, header(p))
+    elif migrate(p, opts.compress):
+      print '%s: migrated' % p
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+# watermark.py - Per-device sync watermarks
+#
+# Copyright (C) 2014 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, json
+import threading
+
+# Local
+from log import log
+
+#
+# Start time of the newest ride already synced from each device (by serial)
+#
+class Watermarks:
+
+  def __init__ ( self, path ):
+    self._path = os.path.expanduser(path)
+    self._lock = threading.Lock()
+    self._data = {}
+    try:
+      self._data = json.load(open(self._path))
+    except IOError:
+      pass
+    except ValueError, e:
+      log('watermark: ignoring corrupt %s [e=%s]' % (self._path, e))
+
+  # Get watermark (None if device never synced)
+  def get ( self, serial ):
+    with self._lock:
+      return self._data.get(serial)
+
+  # Update watermark (only ever moves forward)
+  def set ( self, serial, start ):
+    with self._lock:
+      if start <= self._data.get(serial, start - 1): return
+      self._data[serial] = start
+      d = os.path.dirname(self._path)
+      if d and not os.path.exists(d):
+        os.makedirs(d)
+      tmp = self._path + '.tmp'
+      open(tmp, 'w').write(json.dumps(self._data, indent=2, sort_keys=True))
+      os.rename(tmp, self._path)
+
+# ###########################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ###########################################################################